@@ -0,0 +1,206 @@
+"""非同期 HTTP API サーバー
+
+app.py と同じリクエスト (build_request_dict() と同じキー) を JSON で受け取り、台本を返す。
+agenerate_ad_* / astream_ad_* を 1 つのイベントループ上で同時に走らせるため、リクエストごとのスレッドは作らない。
+同時実行数・レート制限は app.py / batch.py と同じ rate_limit の枠を共有する。
+
+    python api_server.py --host 0.0.0.0 --port 8000
+    # または: uvicorn api_server:app --port 8000  (ワーカーは 1 プロセス・1 ループで使うこと)
+
+    GET  /healthz
+    POST /v1/scripts          全プロバイダーの結果をまとめて JSON で返す
+    POST /v1/scripts/stream   台本の差分を SSE (text/event-stream) で逐次返す
+                              event: delta / done / error (data は provider・index・text)、最後に end
+
+    curl -N -X POST localhost:8000/v1/scripts/stream -H 'Content-Type: application/json' \\
+        -d '{"product_name": "雲ごこちプレミアムピロー", "problem": "首こりで熟睡できない", "promise": "ホテル級の深睡眠"}'
+
+X-Session-Id ヘッダーを付けると、その単位で同時実行枠が公平に配分される (無ければ接続元ごと)。
+SDK の初回 import・キャッシュ (SQLite) の読み書きはスレッドで行い、イベントループを塞がない。
+Gemini の async 呼び出しは gRPC トランスポートが前提 (GEMINI_API_ENDPOINT で REST にした場合は非対応)。
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+import metrics
+from fanout import afan_out_stream
+from providers import PROVIDERS, configured_providers, get_async_generator, get_async_streamer, get_model_name
+from response_cache import get_cache
+from streaming import StreamEvent
+
+# API 専用のフィールド (プロンプトには渡さない)
+_API_ONLY_FIELDS = {"providers", "models", "use_cache"}
+
+
+class AdRequest(BaseModel):
+    """build_request_dict() と同じ項目 + API 専用の指定。既定値は app.py のサイドバーと同じ"""
+
+    product_name: str = Field(..., min_length=1)
+    problem: str = Field(..., min_length=1)
+    promise: str = Field(..., min_length=1)
+    tone: List[str] = Field(default_factory=lambda: ["コミカル"])
+    audience_age: str = "30-50"
+    duration_sec: int = Field(300, ge=30, le=300)
+    n_variations: int = Field(1, ge=1, le=5)
+    temperature: float = Field(0.9, ge=0.0, le=1.5)
+    serif_only: bool = True
+    with_timing: bool = False
+    with_direction: bool = False
+
+    providers: List[str] | None = None  # 省略時は API キーが設定済みの全プロバイダー
+    models: Dict[str, str] | None = None  # プロバイダー名 → モデル名 (既定モデルの上書き)
+    use_cache: bool = True
+
+
+def _to_request(body: AdRequest) -> Dict[str, Any]:
+    """generate_ad_* に渡すリクエスト辞書 (pydantic v1 / v2 の両方に対応)"""
+    data = body.model_dump() if hasattr(body, "model_dump") else body.dict()
+    return {k: v for k, v in data.items() if k not in _API_ONLY_FIELDS}
+
+
+def _providers(body: AdRequest) -> List[str]:
+    configured = [spec.name for spec in configured_providers()]
+    if body.providers is None:
+        if not configured:
+            raise HTTPException(503, "API キーが 1 つも設定されていません。")
+        return configured
+    known = {spec.name for spec in PROVIDERS}
+    unknown = [p for p in body.providers if p not in known]
+    if unknown:
+        raise HTTPException(422, f"未知のプロバイダー: {', '.join(unknown)}")
+    missing = [p for p in body.providers if p not in configured]
+    if missing:
+        raise HTTPException(422, f"API キーが未設定のプロバイダー: {', '.join(missing)}")
+    return body.providers
+
+
+def _bind_session(request: Request) -> None:
+    """同時実行枠の公平配分・計測に使うセッション ID (contextvar はタスク単位で引き継がれる)"""
+    client = request.client.host if request.client else "unknown"
+    metrics.session_id.set(request.headers.get("x-session-id") or f"api:{client}")
+
+
+async def _resolve(provider: str, req: Dict[str, Any], model: str | None) -> Tuple[str, Dict[str, Any]]:
+    """(モデル名, モデル指定を反映した req)。既定モデルの参照は SDK の import を伴うためスレッドで行う"""
+    if model:
+        return model, dict(req, model=model)
+    return await asyncio.to_thread(get_model_name, provider), req
+
+
+async def _run_provider(
+    provider: str, req: Dict[str, Any], model: str | None, use_cache: bool
+) -> Dict[str, Any]:
+    """1 プロバイダー分を生成し、結果レコードを返す (例外は error に格納)。batch._run_task の async 版"""
+    started = time.perf_counter()
+    record: Dict[str, Any] = {"provider": provider, "model": model, "scripts": [], "error": None}
+    try:
+        record["model"], req = await _resolve(provider, req, model)
+        generate_fn = await asyncio.to_thread(get_async_generator, provider)
+        cache = await asyncio.to_thread(get_cache)
+        scripts = await cache.agenerate(provider, record["model"], req, generate_fn, bypass=not use_cache)
+        record["scripts"] = scripts
+        errors = [s for s in scripts if s.startswith("❌")]
+        record["error"] = errors[0] if errors else None
+    except Exception as e:
+        record["error"] = f"❌ {provider} Error: {e}"
+    record["elapsed_sec"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+async def _stream_provider(
+    provider: str, req: Dict[str, Any], model: str | None, use_cache: bool
+) -> AsyncIterator[StreamEvent]:
+    """1 プロバイダー分の StreamEvent。キャッシュにあれば完成済みの台本を done で返す"""
+    model, req = await _resolve(provider, req, model)
+    stream_fn = await asyncio.to_thread(get_async_streamer, provider)
+    cache = await asyncio.to_thread(get_cache)
+    async for event in cache.astream(provider, model, req, stream_fn, bypass=not use_cache):
+        yield event
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+app = FastAPI(title="Ad Script Generator API")
+
+
+@app.get("/healthz")
+async def healthz() -> Dict[str, Any]:
+    return {"ok": True, "providers": [spec.name for spec in configured_providers()]}
+
+
+@app.post("/v1/scripts")
+async def generate_scripts(body: AdRequest, request: Request) -> Dict[str, Any]:
+    """全プロバイダーへ同時に依頼し、すべて揃ってから返す"""
+    providers = _providers(body)
+    _bind_session(request)
+    req = _to_request(body)
+    models = body.models or {}
+    results = await asyncio.gather(
+        *(_run_provider(p, req, models.get(p), body.use_cache) for p in providers)
+    )
+    return {"request": req, "results": list(results)}
+
+
+@app.post("/v1/scripts/stream")
+async def stream_scripts(body: AdRequest, request: Request) -> StreamingResponse:
+    """全プロバイダーを同時にストリーミングし、届いた差分を SSE で逐次送る
+
+    バリエーションごとに delta (追記する差分) が続き、done (長さチェック・続き書き後の最終台本)
+    または error で終わる。index が -1 の error はプロバイダー全体の失敗。最後に end を送る。
+    """
+    providers = _providers(body)
+    _bind_session(request)
+    req = _to_request(body)
+    models = body.models or {}
+    streamers = {
+        p: lambda req, p=p: _stream_provider(p, req, models.get(p), body.use_cache) for p in providers
+    }
+
+    async def _events() -> AsyncIterator[str]:
+        started = time.perf_counter()
+        failures = 0
+        # クライアントが切断するとこのジェネレーターが閉じられ、実行中の呼び出しも取り消される
+        async for provider, event in afan_out_stream(req, streamers):
+            failures += event.kind == "error"
+            yield _sse(event.kind, {"provider": provider, "index": event.index, "text": event.text})
+        yield _sse(
+            "end",
+            {
+                "providers": len(providers),
+                "failures": failures,
+                "elapsed_sec": round(time.perf_counter() - started, 3),
+            },
+        )
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def main(argv: List[str] | None = None) -> int:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="動画広告台本生成の非同期 API サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    # async クライアント・接続プールはイベントループに属するため、1 プロセス・1 ループで動かす
+    uvicorn.run(app, host=args.host, port=args.port, workers=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
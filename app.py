@@ -1,5 +1,7 @@
 # app.py
 import os
+import time
+import uuid
 from typing import List, Dict, Any
 
 import streamlit as st
@@ -8,15 +10,25 @@ import streamlit as st
 # API KEY Loader
 #   - Streamlit Cloud: st.secrets に保存したキーを環境変数へコピー
 #   - ローカル: 既に export した環境変数をそのまま使用
-#   どちらも未設定の場合は下位モジュールでエラーとなります。
+#   どちらも未設定のプロバイダーはタブに表示しません。
 # ─────────────────────────────────────────────────────────────────────────────
-for var in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GOOGLE_GEMINI_API_KEY"):
-    if not os.getenv(var) and var in st.secrets:
-        os.environ[var] = st.secrets[var]
+from providers import PROVIDERS, configured_providers, get_generator, get_model_name, get_streamer
 
-from llm_openai import generate_ad_openai
-from llm_claude import generate_ad_claude
-from llm_gemini import generate_ad_gemini
+for var in (spec.env_var for spec in PROVIDERS):
+    if os.getenv(var):
+        continue
+    try:
+        if var in st.secrets:
+            os.environ[var] = st.secrets[var]
+    except FileNotFoundError:
+        # secrets.toml が無いローカル実行: 環境変数だけを使う
+        break
+
+from jobs import FASTEST, get_jobs
+from history import get_history
+from router import get_router
+from response_cache import get_cache
+import metrics
 
 # ───────────────────────────────────────────────────────────
 # Streamlit – ページ設定
@@ -30,6 +42,22 @@ st.set_page_config(
 st.title("🎬 マルチ LLM 動画広告台本ジェネレーター")
 st.caption("OpenAI / Claude / Gemini をワンタップ比較")
 
+# 実行中ジョブの表示を更新する間隔 (秒)
+_POLL_INTERVAL_SEC = 1.0
+# 履歴ビューの 1 ページあたりの件数
+_HISTORY_PAGE_SIZE = 20
+
+# LLM 呼び出しの計測レコードにセッションを紐づける
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+metrics.session_id.set(st.session_state["session_id"])
+
+# API キーが設定されているプロバイダーのみ利用 (SDK の import は生成時まで遅延)
+active_providers = configured_providers()
+if not active_providers:
+    st.error("API キーが 1 つも設定されていません。OPENAI_API_KEY / ANTHROPIC_API_KEY / GOOGLE_GEMINI_API_KEY のいずれかを設定してください。")
+    st.stop()
+
 # ───────────────────────────────────────────────────────────
 # サイドバー – 入力パラメータ
 # ───────────────────────────────────────────────────────────
@@ -52,6 +80,44 @@ with st.sidebar:
     n_variations = st.slider("生成する広告案数", 1, 5, 1)
     temperature = st.slider("Temperature: AIの自由度(大きいほどランダム性が高い)", 0.0, 1.5, 0.9, 0.1)
 
+    mode = st.radio(
+        "生成モード",
+        ["比較 (プロバイダー別タブ)", "最速 N 本 (モデルを問わず)"],
+        help="最速 N 本: 全プロバイダーへ同時に依頼し、文字数を満たした台本が広告案数だけ揃った時点で表示します。",
+    )
+    fastest_mode = mode.startswith("最速")
+    hedge_after_sec = st.number_input(
+        "ヘッジ開始 (秒, 0 = 無効)",
+        min_value=0.0,
+        max_value=120.0,
+        value=20.0,
+        step=5.0,
+        help="この秒数を過ぎても返ってこないプロバイダーへ、同じリクエストをもう 1 本送ります。",
+        disabled=not fastest_mode,
+    )
+
+    auto_route = st.checkbox(
+        "🧭 モデルを自動選択",
+        value=False,
+        help="直近のレイテンシ・エラー率・続き書き率・コストから、プロバイダーごとにモデルを選びます。",
+    )
+    latency_budget_sec = st.number_input(
+        "レイテンシ予算 (秒, 0 = 指定なし)", min_value=0.0, max_value=600.0, value=0.0, step=5.0, disabled=not auto_route
+    )
+    cost_ceiling_usd = st.number_input(
+        "1 リクエストのコスト上限 (USD, 0 = 指定なし)",
+        min_value=0.0,
+        max_value=1.0,
+        value=0.0,
+        step=0.001,
+        format="%.3f",
+        disabled=not auto_route,
+    )
+
+    bypass_cache = st.checkbox("キャッシュを使わず新しく生成する", value=False)
+    show_metrics = st.checkbox("📊 メトリクスを表示", value=False)
+    show_history = st.checkbox("📚 生成履歴を表示", value=False)
+
     generate_btn = st.button("台本を生成")
 
 # ───────────────────────────────────────────────────────────
@@ -76,47 +142,204 @@ def build_request_dict() -> Dict[str, Any]:
 if generate_btn:
     req = build_request_dict()
 
-    with st.spinner("各 LLM で生成中…"):
-        try:
-            scripts_openai = generate_ad_openai(req)
-        except Exception as e:
-            scripts_openai = [f"❌ OpenAI Error: {e}"]
+    # 同じ入力ならキャッシュから即時表示 (実行中の同一リクエストとは合流)
+    cache = get_cache()
 
+    def _route(provider: str) -> str | None:
+        """自動選択が有効ならルーターでモデルを選ぶ (None = 各モジュールの既定モデル)"""
+        if not auto_route:
+            return None
         try:
-            scripts_claude = generate_ad_claude(req)
-        except Exception as e:
-            scripts_claude = [f"❌ Claude Error: {e}"]
+            return get_router().choose(provider, req, latency_budget_sec or None, cost_ceiling_usd or None)
+        except Exception:
+            # SDK の import 失敗などは、既定モデルのまま生成した際にそのタブでエラー表示する
+            return None
 
-        try:
-            scripts_gemini = generate_ad_gemini(req)
-        except Exception as e:
-            scripts_gemini = [f"❌ Gemini Error: {e}"]
+    models = {spec.name: model for spec in active_providers if (model := _route(spec.name))}
+
+    def _routed(provider: str, r: Dict[str, Any]) -> tuple[str, Dict[str, Any]]:
+        # モジュールの import はワーカースレッド内で行い、失敗してもそのタブだけがエラーになる
+        if provider in models:
+            return models[provider], dict(r, model=models[provider])
+        return get_model_name(provider), r
+
+    def _cached(provider: str):
+        return lambda r: cache.stream(provider, *_routed(provider, r), get_streamer(provider), bypass=bypass_cache)
+
+    def _cached_generator(provider: str, bypass: bool):
+        return lambda r: cache.generate(provider, *_routed(provider, r), get_generator(provider), bypass=bypass)
+
+    # 生成はバックグラウンドのジョブで行い、ここでは job_id を覚えるだけ。
+    # 以降の再実行 (サイドバー操作など) でも生成は中断されず、結果はジョブから読み直す
+    if fastest_mode:
+        st.session_state["job_id"] = get_jobs().submit_fastest(
+            req,
+            {spec.name: _cached_generator(spec.name, bypass_cache) for spec in active_providers},
+            hedge_after_sec=hedge_after_sec or None,
+            # 重複リクエストは実行中の同一リクエストと合流させず、必ず新しく送る
+            hedge_generators={spec.name: _cached_generator(spec.name, True) for spec in active_providers},
+            models=models,
+        )
+    else:
+        st.session_state["job_id"] = get_jobs().submit(
+            req, {spec.name: _cached(spec.name) for spec in active_providers}, models=models
+        )
+
+
+def render_job(job: Dict[str, Any]) -> None:
+    """ジョブの snapshot をタブ × バリエーションで描画"""
+    colors = {spec.name: spec.color for spec in PROVIDERS}
+    labels = {spec.name: spec.label for spec in PROVIDERS}
+    colors[FASTEST] = "#F9A825"
+    labels[FASTEST] = "⚡ 最速 N 本"
 
     # ───────────────────────────────────────────────────────
     # タブ表示 (CSS でブランドカラーを強調)
     # ───────────────────────────────────────────────────────
+    brand_css = "\n".join(
+        f'.stTabs div[data-baseweb="tab"]:nth-child({i}) button {{color:{colors[provider]};}}  /* {provider} */'
+        for i, provider in enumerate(job["providers"], 1)
+    )
     st.markdown(
-        """
+        f"""
         <style>
-        .stTabs [data-baseweb="tab"] span {font-size:1.05rem}
+        .stTabs [data-baseweb="tab"] span {{font-size:1.05rem}}
         /* ブランド別色分け */
-        .stTabs div[data-baseweb="tab"]:nth-child(1) button {color:#00a67e;}  /* OpenAI 緑 */
-        .stTabs div[data-baseweb="tab"]:nth-child(2) button {color:#6f4cff;}  /* Claude 紫 */
-        .stTabs div[data-baseweb="tab"]:nth-child(3) button {color:#4285F4;}  /* Gemini 青 */
+        {brand_css}
         </style>
         """,
         unsafe_allow_html=True,
     )
 
-    tabs = st.tabs(["OpenAI GPT-4o", "Claude 3 Haiku", "Gemini 1.5"])
-
-    for tab, scripts, provider in zip(
-        tabs,
-        [scripts_openai, scripts_claude, scripts_gemini],
-        ["OpenAI", "Claude", "Gemini"],
-    ):
+    tabs = st.tabs([labels[provider] for provider in job["providers"]])
+    n = job["req"]["n_variations"]
+    for tab, provider in zip(tabs, job["providers"]):
+        name = "最速モード" if provider == FASTEST else provider
+        if provider in job["models"]:
+            name += f" ({job['models'][provider]})"
         with tab:
-            for i, script in enumerate(scripts, 1):
-                with st.expander(f"{provider} バリエーション {i}", expanded=(i == 1)):
-                    st.markdown(f"```markdown\n{script}\n```")
-            st.success(f"{provider} で {len(scripts)} 本生成完了 ✅")
+            titles = job["titles"].get(provider, [])
+            for i, text in enumerate(job["texts"][provider], 1):
+                title = titles[i - 1] if i <= len(titles) else provider
+                with st.expander(f"{title} バリエーション {i}", expanded=(i == 1)):
+                    st.markdown(f"```markdown\n{text}\n```")
+            if provider in job["errors"]:
+                # バリエーションに紐づかないエラー (クライアント初期化失敗など)
+                st.error(job["errors"][provider])
+            elif job["status"] == "done":
+                # 最速モードはプロバイダーの失敗などで n 本に届かないことがある
+                ok = sum(1 for text in job["texts"][provider] if text and not text.startswith("❌"))
+                if ok < n:
+                    st.warning(f"{name} で {n} 本中 {ok} 本のみ生成できました ⚠️")
+                else:
+                    st.success(f"{name} で {n} 本生成完了 ✅")
+            elif job["status"] == "queued":
+                st.info(f"{name} は開始待ちです…")
+            else:
+                st.info(f"{name} で生成中…")
+
+
+@st.experimental_fragment(run_every=_POLL_INTERVAL_SEC)
+def poll_job(job_id: str) -> None:
+    """実行中のジョブだけを一定間隔で再描画する (ページ全体は再実行しない)"""
+    job = get_jobs().get(job_id)
+    if job is None:
+        return
+    render_job(job.snapshot())
+    if job.done:
+        # 完了したらページ全体を 1 回再実行し、ポーリングを止める
+        st.rerun()
+
+
+job_id = st.session_state.get("job_id")
+if job_id:
+    job = get_jobs().get(job_id)
+    if job is None:
+        st.warning("生成結果の保持期限が切れました。もう一度生成してください。")
+    elif job.done:
+        render_job(job.snapshot())
+    else:
+        poll_job(job_id)
+
+# ───────────────────────────────────────────────────────────
+# メトリクスパネル (このセッションの p50/p95 レイテンシ・続き書き率・コスト)
+# ───────────────────────────────────────────────────────────
+if show_metrics:
+    st.subheader("📊 LLM メトリクス (このセッション)")
+    summary = metrics.summarize(metrics.recent_records(st.session_state["session_id"]))
+    if summary:
+        st.dataframe(summary, use_container_width=True)
+        st.caption(
+            "レイテンシ・TTFT はプロバイダー側の時間 (下書き呼び出しのみ・秒)。"
+            "queue_p95_sec = レート制御・同時実行枠・再試行で手元で待った時間。"
+            "extend_rate = 下書き 1 本あたりの続き書き発生率。"
+        )
+    else:
+        st.caption("まだ LLM の呼び出しがありません。")
+
+    if auto_route:
+        st.subheader("🧭 モデル自動選択の統計 (全セッション)")
+        st.dataframe(get_router().summary(), use_container_width=True)
+        st.caption("移動平均 (EWMA)。degraded = エラー率が高く、一時的に候補から外しているモデル。")
+
+# ───────────────────────────────────────────────────────────
+# 生成履歴 (全文検索 + ページ送り)
+#   - 1 ページ分の冒頭だけを描画し、全文は「開く」を押した 1 本だけ読み込む
+#   - フラグメント内の操作はこのパネルだけを再実行する
+# ───────────────────────────────────────────────────────────
+@st.experimental_fragment
+def history_panel() -> None:
+    history = get_history()
+    st.subheader("📚 生成履歴")
+
+    col_query, col_product, col_provider = st.columns([2, 1, 1])
+    query = col_query.text_input("台本を検索 (スペース区切りで AND)", key="history_query")
+    product = col_product.text_input("商品名 (前方一致)", key="history_product")
+    provider = col_provider.selectbox(
+        "プロバイダー", ["(すべて)"] + [spec.name for spec in PROVIDERS], key="history_provider"
+    )
+    filters = {
+        "query": query,
+        "product_prefix": product.strip() or None,
+        "provider": None if provider == "(すべて)" else provider,
+    }
+
+    # 条件が変わったら 1 ページ目へ戻す。cursors[i] = i ページ目の before_id
+    if st.session_state.get("history_filters") != filters:
+        st.session_state["history_filters"] = filters
+        st.session_state["history_cursors"] = [None]
+        st.session_state["history_open"] = None
+    cursors: List[int | None] = st.session_state["history_cursors"]
+
+    total = history.count(**filters)
+    rows = history.search(**filters, before_id=cursors[-1], limit=_HISTORY_PAGE_SIZE)
+    page = len(cursors)
+    st.caption(f"{total} 件中 {(page - 1) * _HISTORY_PAGE_SIZE + 1 if rows else 0}–{(page - 1) * _HISTORY_PAGE_SIZE + len(rows)} 件目")
+
+    for row in rows:
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(row["created_at"]))
+        col_text, col_button = st.columns([5, 1])
+        col_text.markdown(
+            f"**{row['product_name']}** · {row['provider']} · {created} · {row['length']} 文字  \n"
+            f"{row['preview']}{'…' if row['length'] > len(row['preview']) else ''}"
+        )
+        if col_button.button("開く", key=f"history_open_{row['id']}"):
+            st.session_state["history_open"] = row["id"]
+        if st.session_state.get("history_open") == row["id"]:
+            record = history.get_script(row["id"])
+            if record:
+                st.markdown(f"```markdown\n{record['script']}\n```")
+                st.json(record["request"], expanded=False)
+
+    # ページ送りは on_click でカーソルを動かし、続くフラグメントの再実行で新しいページを描く
+    col_prev, col_next = st.columns(2)
+    col_prev.button("← 新しい方へ", disabled=page == 1, on_click=cursors.pop)
+    col_next.button(
+        "古い方へ →",
+        disabled=len(rows) < _HISTORY_PAGE_SIZE,
+        on_click=lambda: cursors.append(rows[-1]["id"]),
+    )
+
+
+if show_history:
+    history_panel()
@@ -0,0 +1,254 @@
+"""ヘッドレス一括生成 CLI
+
+CSV / JSONL の商品行 (app.py の build_request_dict() と同じキー) を読み込み、
+行 × プロバイダーを上限付きのワーカープールで生成して、終わった順に JSONL へ追記する。
+中断後に同じコマンドを再実行すると、出力済みの (行, プロバイダー) は飛ばして再開する。
+
+Ctrl-C を 1 回押すと新しいタスクの投入をやめ、実行中の呼び出しの完了を待って結果を書き出してから終了する
+(支払い済みの結果を捨てない)。もう一度 Ctrl-C を押すと実行中の呼び出しを待たずに即座に終了する。
+
+使い方:
+    python batch.py products.csv -o results.jsonl --workers 8
+    python batch.py products.jsonl -o results.jsonl --providers OpenAI Claude
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from providers import configured_providers, get_generator, get_model_name
+from response_cache import get_cache
+
+# app.py のサイドバー既定値と同じ
+_DEFAULT_REQUEST: Dict[str, Any] = {
+    "tone": ["コミカル"],
+    "audience_age": "30-50",
+    "duration_sec": 300,
+    "n_variations": 1,
+    "temperature": 0.9,
+    "serif_only": True,
+    "with_timing": False,
+    "with_direction": False,
+}
+_INT_KEYS = {"duration_sec", "n_variations"}
+_FLOAT_KEYS = {"temperature"}
+_BOOL_KEYS = {"serif_only", "with_timing", "with_direction"}
+
+
+def _parse_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in {"1", "true", "yes", "y"}
+
+
+def _to_request(row: Dict[str, Any]) -> Dict[str, Any]:
+    """1 行分を build_request_dict() と同じ形の辞書へ変換 (CSV の文字列も型変換)"""
+    req = dict(_DEFAULT_REQUEST)
+    for key, value in row.items():
+        if key == "id" or value in (None, ""):
+            continue
+        if key == "tone" and isinstance(value, str):
+            # CSV では "コミカル|ドラマ" のように | 区切り
+            value = [t.strip() for t in value.split("|") if t.strip()]
+        elif key in _INT_KEYS:
+            value = int(value)
+        elif key in _FLOAT_KEYS:
+            value = float(value)
+        elif key in _BOOL_KEYS:
+            value = _parse_bool(value)
+        req[key] = value
+    return req
+
+
+def read_rows(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """入力ファイルから (row_id, request) を順に返す。id 列が無ければ行番号を使う"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.endswith(".jsonl"):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for i, row in enumerate(rows, 1):
+            yield str(row.get("id") or i), _to_request(row)
+
+
+def load_done(path: str) -> Set[Tuple[str, str]]:
+    """出力済みで成功している (row_id, provider) の集合。途中で切れた行は無視する"""
+    done: Set[Tuple[str, str]] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # クラッシュ時に書きかけだった行
+            if not record.get("error"):
+                done.add((record["row_id"], record["provider"]))
+    return done
+
+
+def _terminate_partial_line(path: str) -> None:
+    """クラッシュ時の書きかけ行が改行で終わっていなければ改行を補う
+
+    そのまま "a" で開くと、次のレコードが書きかけ行に連結されて読めなくなり、
+    再開のたびに生成し直されてしまう。書きかけ行自体は load_done() が読み飛ばす。
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def _run_task(row_id: str, provider: str, req: Dict[str, Any], use_cache: bool) -> Dict[str, Any]:
+    """1 行 × 1 プロバイダー分を生成し、出力レコードを返す (例外は error に格納)"""
+    started = time.perf_counter()
+    record: Dict[str, Any] = {"row_id": row_id, "provider": provider, "request": req}
+    try:
+        record["model"] = get_model_name(provider)
+        generate_fn = get_generator(provider)
+        if use_cache:
+            scripts = get_cache().generate(provider, record["model"], req, generate_fn)
+        else:
+            scripts = generate_fn(req)
+        record["scripts"] = scripts
+        errors = [s for s in scripts if s.startswith("❌")]
+        record["error"] = errors[0] if errors else None
+    except Exception as e:
+        record["scripts"] = []
+        record["error"] = f"❌ {provider} Error: {e}"
+    record["elapsed_sec"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run_batch(
+    input_path: str,
+    output_path: str,
+    providers: List[str],
+    workers: int = 4,
+    use_cache: bool = True,
+) -> Dict[str, Any]:
+    """一括生成を実行し、集計 (件数・経過時間・行/分) を返す"""
+    rows = list(read_rows(input_path))
+    done = load_done(output_path)
+
+    tasks = [
+        (row_id, provider, req)
+        for row_id, req in rows
+        for provider in providers
+        if (row_id, provider) not in done
+    ]
+    remaining: Dict[str, int] = {}
+    for row_id, _, _ in tasks:
+        remaining[row_id] = remaining.get(row_id, 0) + 1
+
+    print(
+        f"{len(rows)} 行 × {len(providers)} プロバイダー: "
+        f"出力済み {len(rows) * len(providers) - len(tasks)} 件をスキップ、残り {len(tasks)} 件",
+        file=sys.stderr,
+    )
+
+    started = time.perf_counter()
+    rows_completed = 0
+    failures = 0
+    interrupted = False
+    _terminate_partial_line(output_path)
+    queue = iter(tasks)
+    pending: Set[Future] = set()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    # 出力ファイルへの書き込みはメインスレッドだけが行う (1 件ごとに flush → 中断しても再開可能)
+    try:
+        with open(output_path, "a", encoding="utf-8") as out:
+            while True:
+                try:
+                    # 投入はワーカー数ぶんまで。中断時に待つ呼び出しを最小限にする
+                    if not interrupted:
+                        for row_id, provider, req in islice(queue, workers - len(pending)):
+                            pending.add(executor.submit(_run_task, row_id, provider, req, use_cache))
+                    if not pending:
+                        break
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record = future.result()
+                        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                        out.flush()
+                        # 書き出してから外す (途中で中断されても結果を取りこぼさない。重複行は load_done が吸収)
+                        pending.discard(future)
+
+                        if record["error"]:
+                            failures += 1
+                            print(f"[{record['row_id']}] {record['provider']}: {record['error']}", file=sys.stderr)
+                        remaining[record["row_id"]] -= 1
+                        if remaining[record["row_id"]] == 0:
+                            rows_completed += 1
+                except KeyboardInterrupt:
+                    if interrupted:
+                        raise  # 2 回目の Ctrl-C: 即時終了 (main で処理)
+                    interrupted = True
+                    # 未着手のタスクだけ取り消し、実行中の呼び出しは結果を書き出すまで待つ
+                    pending = {f for f in pending if not f.cancel()}
+                    print(
+                        f"中断します: 実行中の {len(pending)} 件の完了を待って書き出します "
+                        "(もう一度 Ctrl-C で即時終了)",
+                        file=sys.stderr,
+                    )
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    elapsed = time.perf_counter() - started
+    return {
+        "rows": rows_completed,
+        "tasks": len(tasks),
+        "failures": failures,
+        "elapsed_sec": round(elapsed, 2),
+        "rows_per_min": round(rows_completed / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "interrupted": interrupted,
+    }
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="動画広告台本の一括生成 (再開可能な JSONL 出力)")
+    parser.add_argument("input", help="商品行の CSV または JSONL")
+    parser.add_argument("-o", "--output", required=True, help="結果を追記する JSONL")
+    parser.add_argument(
+        "--providers",
+        nargs="+",
+        default=None,
+        help="使うプロバイダー (既定: API キーが設定済みのもの全て)",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="同時実行数 (行 × プロバイダー単位)")
+    parser.add_argument("--no-cache", action="store_true", help="生成結果キャッシュを使わない")
+    args = parser.parse_args(argv)
+
+    providers = args.providers or [spec.name for spec in configured_providers()]
+    if not providers:
+        parser.error("API キーが 1 つも設定されていません。")
+
+    try:
+        summary = run_batch(args.input, args.output, providers, workers=args.workers, use_cache=not args.no_cache)
+    except KeyboardInterrupt:
+        print("強制終了しました。実行中だった呼び出しの結果は書き出されていません。", file=sys.stderr)
+        sys.stderr.flush()
+        # ワーカースレッドの終了 (= 実行中の API 呼び出し) を待たずにプロセスを終える
+        os._exit(130)
+    print(
+        f"{'中断' if summary['interrupted'] else '完了'}: {summary['rows']} 行 / {summary['tasks']} 件 "
+        f"(失敗 {summary['failures']} 件) {summary['elapsed_sec']} 秒 → {summary['rows_per_min']} 行/分",
+        file=sys.stderr,
+    )
+    if summary["interrupted"]:
+        print("同じコマンドを再実行すると続きから再開します。", file=sys.stderr)
+        return 130
+    return 1 if summary["failures"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,238 @@
+"""オフラインベンチマーク
+
+stub_servers.py のスタブへ SDK クライアントを向け、実 API の料金をかけずに
+生成パイプラインのレイテンシ・スループット・続き書き (extend) 回数を測る。
+
+    python bench.py --mode generate --iterations 20 --concurrency 4
+    python bench.py --mode stream --n-variations 3 --output-chars 1500
+    python bench.py --mode app --iterations 5            # Streamlit AppTest で app.py を実行
+    python bench.py --mode generate --output now.json --baseline before.json
+
+--output で結果を JSON 保存し、次回 --baseline に渡すと前回比を表示する。
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from stub_servers import StubConfig, StubServer
+
+_PROVIDERS = ["OpenAI", "Claude", "Gemini"]
+
+
+def _configure_env(server: StubServer, workdir: str) -> None:
+    """スタブ向けの環境変数を設定する。llm_*.py / metrics の import より前に呼ぶこと"""
+    os.environ.update(server.env())
+    os.environ["LLM_TRACE_PATH"] = os.path.join(workdir, "llm_trace.jsonl")
+    os.environ["AD_CACHE_PATH"] = os.path.join(workdir, "ad_scripts.sqlite3")
+    # ベンチマーク中はクライアント側のレート制限がボトルネックにならないようにする
+    for prefix in ("OPENAI", "CLAUDE", "GEMINI"):
+        os.environ.setdefault(f"{prefix}_RPM", "100000")
+        os.environ.setdefault(f"{prefix}_TPM", "100000000")
+
+
+def _sample_request(n_variations: int, duration_sec: int) -> Dict[str, Any]:
+    """app.py のサイドバー既定値と同じリクエスト"""
+    return {
+        "product_name": "雲ごこちプレミアムピロー",
+        "problem": "首こりで熟睡できない",
+        "promise": "ホテル級の深睡眠",
+        "tone": ["コミカル"],
+        "audience_age": "30-50",
+        "duration_sec": duration_sec,
+        "n_variations": n_variations,
+        "temperature": 0.9,
+        "serif_only": True,
+        "with_timing": False,
+        "with_direction": False,
+    }
+
+
+def _summarize(latencies: List[float], ttfts: List[float], scripts: int, errors: int, wall_sec: float) -> Dict[str, Any]:
+    from metrics import percentile
+
+    return {
+        "runs": len(latencies),
+        "errors": errors,
+        "latency_p50_sec": percentile(latencies, 50),
+        "latency_p95_sec": percentile(latencies, 95),
+        "latency_mean_sec": round(sum(latencies) / len(latencies), 4) if latencies else None,
+        "ttft_p50_sec": percentile(ttfts, 50),
+        "scripts": scripts,
+        "throughput_scripts_per_sec": round(scripts / wall_sec, 3) if wall_sec > 0 else None,
+        "wall_sec": round(wall_sec, 3),
+    }
+
+
+def bench_functions(
+    providers: List[str], mode: str, req: Dict[str, Any], iterations: int, concurrency: int
+) -> Dict[str, Dict[str, Any]]:
+    """generate_ad_* / stream_ad_* を直接呼び出して計測 (キャッシュは通さない)"""
+    from providers import get_generator, get_streamer
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for provider in providers:
+        def _run_once(_: int, provider: str = provider) -> tuple[float, float | None, int, bool]:
+            started = time.perf_counter()
+            ttft: float | None = None
+            try:
+                if mode == "stream":
+                    finals = 0
+                    failed = False
+                    for event in get_streamer(provider)(req):
+                        if ttft is None:
+                            ttft = time.perf_counter() - started
+                        if event.kind == "done":
+                            finals += 1
+                        elif event.kind == "error":
+                            failed = True
+                    return time.perf_counter() - started, ttft, finals, failed
+                scripts = get_generator(provider)(req)
+                failed = any(s.startswith("❌") for s in scripts)
+                return time.perf_counter() - started, None, len(scripts), failed
+            except Exception as e:
+                print(f"{provider}: {e}", file=sys.stderr)
+                return time.perf_counter() - started, ttft, 0, True
+
+        wall_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            runs = list(executor.map(_run_once, range(iterations)))
+        wall_sec = time.perf_counter() - wall_started
+
+        results[provider] = _summarize(
+            [r[0] for r in runs if not r[3]],
+            [r[1] for r in runs if r[1] is not None],
+            sum(r[2] for r in runs),
+            sum(1 for r in runs if r[3]),
+            wall_sec,
+        )
+    return results
+
+
+def bench_app(iterations: int, timeout: float) -> Dict[str, Dict[str, Any]]:
+    """Streamlit AppTest で app.py の「台本を生成」を押し、バックグラウンドジョブの完了までを測る"""
+    from streamlit.testing.v1 import AppTest
+
+    from jobs import get_jobs
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    at = AppTest.from_file(app_path, default_timeout=timeout)
+    at.run()
+    # 毎回プロバイダーを呼ぶようキャッシュを無効化
+    next(c for c in at.checkbox if c.label.startswith("キャッシュ")).check()
+
+    latencies: List[float] = []
+    errors = 0
+    wall_started = time.perf_counter()
+    for _ in range(iterations):
+        started = time.perf_counter()
+        next(b for b in at.button if b.label == "台本を生成").click()
+        at.run()
+        # AppTest は同一プロセスで動くため、ジョブキューを直接見て完了を待つ
+        job = get_jobs().get(at.session_state["job_id"])
+        while not job.done:
+            time.sleep(0.05)
+        latencies.append(time.perf_counter() - started)
+        at.run()
+        errors += len(at.exception)
+    wall_sec = time.perf_counter() - wall_started
+
+    n_variations = next(s for s in at.slider if s.label == "生成する広告案数").value
+    scripts = iterations * n_variations * len(_PROVIDERS)
+    return {"app": _summarize(latencies, [], scripts, errors, wall_sec)}
+
+
+def _stub_call_counts(before: Dict[str, int], after: Dict[str, int]) -> Dict[str, Dict[str, int]]:
+    """スタブのカウンタ差分からプロバイダー別のリクエスト数・続き書き数・エラー数を出す"""
+    counts: Dict[str, Dict[str, int]] = {}
+    for provider in _PROVIDERS:
+        delta = {
+            kind: after.get(f"{provider}:{kind}", 0) - before.get(f"{provider}:{kind}", 0)
+            for kind in ("requests", "extend", "429", "503")
+        }
+        if delta["requests"]:
+            counts[provider] = delta
+    return counts
+
+
+def _print_report(report: Dict[str, Any], baseline: Dict[str, Any] | None) -> None:
+    print(f"\n== bench mode={report['mode']} iterations={report['iterations']} concurrency={report['concurrency']} ==")
+    for name, row in report["results"].items():
+        stub = report["stub_calls"].get(name, {})
+        line = (
+            f"{name:8s} p50={row['latency_p50_sec']}s p95={row['latency_p95_sec']}s "
+            f"ttft_p50={row['ttft_p50_sec']}s throughput={row['throughput_scripts_per_sec']} scripts/s "
+            f"errors={row['errors']}"
+        )
+        if stub:
+            line += f" requests={stub['requests']} extend={stub['extend']} 429={stub['429']} 503={stub['503']}"
+        print(line)
+
+        base = (baseline or {}).get("results", {}).get(name)
+        if base:
+            for key in ("latency_p50_sec", "latency_p95_sec", "throughput_scripts_per_sec"):
+                if base.get(key) and row.get(key):
+                    print(f"{'':8s}  {key}: {base[key]} → {row[key]} ({(row[key] / base[key] - 1) * 100:+.1f}%)")
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="スタブサーバーを使ったオフラインベンチマーク")
+    parser.add_argument("--mode", choices=["generate", "stream", "app"], default="generate")
+    parser.add_argument("--providers", nargs="+", default=_PROVIDERS, choices=_PROVIDERS)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1, help="プロバイダーごとの同時実行数")
+    parser.add_argument("--n-variations", type=int, default=1)
+    parser.add_argument("--duration-sec", type=int, default=300)
+    parser.add_argument("--app-timeout", type=float, default=300.0)
+    parser.add_argument("--output", help="結果を JSON で保存")
+    parser.add_argument("--baseline", help="比較対象の JSON (以前の --output)")
+    for field, default in StubConfig._field_defaults.items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args(argv)
+
+    config = StubConfig(**{field: getattr(args, field) for field in StubConfig._fields})
+    server = StubServer(config=config).start()
+    workdir = tempfile.mkdtemp(prefix="ad-bench-")
+    _configure_env(server, workdir)
+
+    try:
+        before = server.state.snapshot()
+        if args.mode == "app":
+            results = bench_app(args.iterations, args.app_timeout)
+        else:
+            req = _sample_request(args.n_variations, args.duration_sec)
+            results = bench_functions(args.providers, args.mode, req, args.iterations, args.concurrency)
+        after = server.state.snapshot()
+    finally:
+        server.stop()
+
+    report = {
+        "mode": args.mode,
+        "iterations": args.iterations,
+        "concurrency": args.concurrency,
+        "n_variations": args.n_variations,
+        "duration_sec": args.duration_sec,
+        "stub_config": config._asdict(),
+        "results": results,
+        "stub_calls": _stub_call_counts(before, after),
+        "trace_path": os.environ["LLM_TRACE_PATH"],
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    _print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
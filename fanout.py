@@ -0,0 +1,167 @@
+import asyncio
+import contextvars
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Tuple, TypeVar
+
+from streaming import StreamEvent
+
+# ────────────────────────────────────────────────────────────────────────────
+# 複数 LLM への同時リクエスト (fan-out) エンジン
+#   - 各プロバイダーを別スレッドで同時に実行し、終わった順に結果を返す
+#   - 1 社のエラーは文字列として閉じ込め、他社の結果には影響させない
+#   - a 付きの関数は api_server 用の async 版 (スレッドの代わりにタスクで同時実行)
+# ────────────────────────────────────────────────────────────────────────────
+
+GenerateFn = Callable[[Dict[str, Any]], List[str]]
+StreamFn = Callable[[Dict[str, Any]], Iterator[StreamEvent]]
+AsyncStreamFn = Callable[[Dict[str, Any]], AsyncIterator[StreamEvent]]
+
+T = TypeVar("T")
+
+
+def bind_context(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """呼び出し元の contextvars (metrics.session_id など) をワーカースレッドへ引き継ぐ"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def safe_generate(provider: str, fn: GenerateFn, req: Dict[str, Any]) -> List[str]:
+    """例外を app.py 従来の `❌ {provider} Error: ...` 形式へ変換して返す"""
+    try:
+        return fn(req)
+    except Exception as e:
+        return [f"❌ {provider} Error: {e}"]
+
+
+def fan_out_stream(
+    req: Dict[str, Any],
+    streamers: Dict[str, StreamFn],
+    max_workers: int | None = None,
+) -> Iterator[Tuple[str, StreamEvent]]:
+    """streamers の全プロバイダーを同時にストリーミングし、届いた順に (provider, event) を yield
+
+    各スレッドはイベントをキューへ積むだけで、UI 描画は呼び出し側 (メインスレッド) で行う。
+    """
+    if not streamers:
+        return
+
+    events: "queue.Queue[Tuple[str, StreamEvent | None]]" = queue.Queue()
+
+    def _pump(provider: str, fn: StreamFn) -> None:
+        try:
+            for event in fn(req):
+                events.put((provider, event))
+        except Exception as e:
+            events.put((provider, StreamEvent(-1, "error", f"❌ {provider} Error: {e}")))
+        finally:
+            events.put((provider, None))  # 終了通知
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(streamers)) as executor:
+        for provider, fn in streamers.items():
+            executor.submit(bind_context(_pump), provider, fn)
+
+        remaining = len(streamers)
+        while remaining:
+            provider, event = events.get()
+            if event is None:
+                remaining -= 1
+                continue
+            yield provider, event
+
+
+def merge_streams(
+    streams: List[Callable[[], Iterator[StreamEvent]]],
+    max_workers: int | None = None,
+) -> Iterator[StreamEvent]:
+    """複数のイベントストリームを最大 max_workers 本ずつ同時に実行し、届いた順に yield
+
+    バリエーションごとのストリームを並列に流すために使う。例外は呼び出し側へ再送出する。
+    """
+    if not streams:
+        return
+
+    events: "queue.Queue[StreamEvent | BaseException | None]" = queue.Queue()
+
+    def _pump(stream: Callable[[], Iterator[StreamEvent]]) -> None:
+        try:
+            for event in stream():
+                events.put(event)
+        except BaseException as e:
+            events.put(e)
+        finally:
+            events.put(None)  # 終了通知
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(streams)) as executor:
+        for stream in streams:
+            executor.submit(bind_context(_pump), stream)
+
+        remaining = len(streams)
+        while remaining:
+            event = events.get()
+            if event is None:
+                remaining -= 1
+            elif isinstance(event, BaseException):
+                raise event
+            else:
+                yield event
+
+
+async def amerge_streams(
+    streams: List[Callable[[], AsyncIterator[T]]],
+    max_concurrency: int | None = None,
+) -> AsyncIterator[T]:
+    """merge_streams の async 版。最大 max_concurrency 本ずつ同時に実行し、届いた順に yield
+
+    途中で閉じられた (クライアント切断など) 場合は、実行中のストリームをすべて取り消す。
+    """
+    if not streams:
+        return
+
+    events: "asyncio.Queue[T | BaseException | None]" = asyncio.Queue()
+    semaphore = asyncio.Semaphore(max_concurrency or len(streams))
+
+    async def _pump(stream: Callable[[], AsyncIterator[T]]) -> None:
+        try:
+            async with semaphore:
+                async for event in stream():
+                    events.put_nowait(event)
+        except Exception as e:
+            events.put_nowait(e)
+        finally:
+            events.put_nowait(None)  # 終了通知
+
+    # create_task は呼び出し元の contextvars (metrics.session_id など) を引き継ぐ
+    tasks = [asyncio.create_task(_pump(stream)) for stream in streams]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            event = await events.get()
+            if event is None:
+                remaining -= 1
+            elif isinstance(event, BaseException):
+                raise event
+            else:
+                yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def afan_out_stream(
+    req: Dict[str, Any],
+    streamers: Dict[str, AsyncStreamFn],
+) -> AsyncIterator[Tuple[str, StreamEvent]]:
+    """fan_out_stream の async 版。全プロバイダーを同時にストリーミングし、届いた順に (provider, event) を yield"""
+
+    async def _tagged(provider: str, fn: AsyncStreamFn) -> AsyncIterator[Tuple[str, StreamEvent]]:
+        try:
+            async for event in fn(req):
+                yield provider, event
+        except Exception as e:
+            yield provider, StreamEvent(-1, "error", f"❌ {provider} Error: {e}")
+
+    async for item in amerge_streams(
+        [lambda provider=provider, fn=fn: _tagged(provider, fn) for provider, fn in streamers.items()]
+    ):
+        yield item
@@ -0,0 +1,100 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from fanout import GenerateFn, bind_context, safe_generate
+from length_utils import count_chars, missing_chars, target_chars
+
+# ────────────────────────────────────────────────────────────────────────────
+# 最速 N 本モード (fastest-first + hedged request)
+#   - 全プロバイダーへ同時に generate_ad_* を投げ、文字数チェックを通った台本が
+#     N 本そろった時点で返す (どのモデルが書いたかは問わない)
+#   - hedge_after_sec を過ぎても返ってこないプロバイダーには同じリクエストを 1 回だけ重複送信
+#   - 残りの呼び出しは待たずに打ち切る。Python のスレッドは中断できないため、
+#     送信済みの呼び出しはバックグラウンドで完了し、キャッシュ経由なら結果は再利用される
+# ────────────────────────────────────────────────────────────────────────────
+
+
+class HedgeResult(NamedTuple):
+    provider: str
+    script: str
+    passed: bool  # 文字数チェック (missing_chars == 0) を満たしたか
+    hedged: bool  # ヘッジ (重複リクエスト) 側の結果か
+    elapsed_sec: float  # 開始からこの結果が届くまで
+
+
+def fastest_first(
+    req: Dict[str, Any],
+    generators: Dict[str, GenerateFn],
+    n_needed: int | None = None,
+    hedge_after_sec: float | None = None,
+    hedge_generators: Dict[str, GenerateFn] | None = None,
+) -> List[HedgeResult]:
+    """文字数チェックを通った台本を、届いた順に最大 n_needed 本返す
+
+    Parameters
+    ----------
+    generators : プロバイダー名 → generate_ad_* (キャッシュ経由でもよい)
+    n_needed : 必要な本数。省略時は req["n_variations"]
+    hedge_after_sec : この秒数を過ぎて未完了のプロバイダーへ重複リクエストを送る (None / 0 で無効)
+    hedge_generators : 重複リクエストに使う関数。実行中の同一リクエストと合流しないよう、
+        キャッシュを読まない版を渡す。省略時は generators
+
+    全呼び出しが終わっても n_needed 本に届かなければ、チェックを通らなかった台本を
+    長い順に補って返す (passed=False)。
+    """
+    n_needed = n_needed or int(req.get("n_variations", 1))
+    min_chars = target_chars(int(req.get("duration_sec", 30)))
+    hedge_generators = hedge_generators or generators
+    if not generators:
+        return []
+
+    started = time.perf_counter()
+    hedge_at = started + hedge_after_sec if hedge_after_sec else None
+    passed: List[HedgeResult] = []
+    rejected: List[HedgeResult] = []
+    completed: set[str] = set()
+
+    # 重複リクエスト分も含めて全呼び出しを同時に走らせる
+    executor = ThreadPoolExecutor(max_workers=2 * len(generators), thread_name_prefix="ad-hedge")
+    futures: Dict[Future, Tuple[str, bool]] = {
+        executor.submit(bind_context(safe_generate), provider, fn, req): (provider, False)
+        for provider, fn in generators.items()
+    }
+    pending = set(futures)
+    try:
+        while pending and len(passed) < n_needed:
+            timeout = None if hedge_at is None else max(0.0, hedge_at - time.perf_counter())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                # しきい値を過ぎても返ってこないプロバイダーへ重複リクエスト
+                for provider in {futures[f][0] for f in pending} - completed:
+                    if provider in hedge_generators:
+                        future = executor.submit(bind_context(safe_generate), provider, hedge_generators[provider], req)
+                        futures[future] = (provider, True)
+                        pending.add(future)
+                hedge_at = None
+                continue
+
+            for future in done:
+                provider, hedged = futures[future]
+                completed.add(provider)
+                elapsed = round(time.perf_counter() - started, 3)
+                for script in future.result():
+                    ok = not script.startswith("❌") and missing_chars(script, min_chars) == 0
+                    (passed if ok else rejected).append(HedgeResult(provider, script, ok, hedged, elapsed))
+    finally:
+        # 未着手の呼び出しは取り消し、実行中のものは待たない
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    results = passed[:n_needed]
+    if len(results) < n_needed:
+        usable = sorted(
+            (r for r in rejected if not r.script.startswith("❌")),
+            key=lambda r: count_chars(r.script),
+            reverse=True,
+        )
+        errors = [r for r in rejected if r.script.startswith("❌")]
+        results += (usable + errors)[: n_needed - len(results)]
+    return results
@@ -0,0 +1,193 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+# ────────────────────────────────────────────────────────────────────────────
+# 生成履歴ストア
+#   - リクエスト辞書と生成された台本を SQLite に保存 (1 リクエスト = 1 行、台本ごとに 1 行)
+#   - 台本本文は FTS5 (trigram) で全文検索。日本語でも分かち書きなしで部分一致が引ける
+#   - 商品名・プロバイダー・日時にインデックスを張り、数万件でも一覧・絞り込みを高速に保つ
+#   - 一覧は本文の冒頭だけを返し、全文は get_script() で開いたときに読む
+# ────────────────────────────────────────────────────────────────────────────
+
+_HISTORY_PATH = os.getenv("AD_HISTORY_PATH", os.path.join(".cache", "ad_history.sqlite3"))
+
+# 商品名の前方一致を範囲検索にするときの上限 (BINARY 照合で最大のコードポイント)
+_PREFIX_END = "\U0010ffff"
+# 一覧に載せる本文の冒頭文字数
+_PREVIEW_CHARS = 120
+# trigram トークナイザは 3 文字未満の語を検索できないため、短い語は LIKE で探す
+_MIN_FTS_CHARS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id           INTEGER PRIMARY KEY,
+    created_at   REAL NOT NULL,
+    session_id   TEXT,
+    mode         TEXT NOT NULL,
+    product_name TEXT NOT NULL,
+    request      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_requests_product ON requests(product_name, id);
+CREATE INDEX IF NOT EXISTS idx_requests_created ON requests(created_at);
+
+CREATE TABLE IF NOT EXISTS scripts (
+    id          INTEGER PRIMARY KEY,
+    request_id  INTEGER NOT NULL REFERENCES requests(id) ON DELETE CASCADE,
+    created_at  REAL NOT NULL,
+    provider    TEXT NOT NULL,
+    model       TEXT,
+    variation   INTEGER NOT NULL,
+    script      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_scripts_request ON scripts(request_id);
+CREATE INDEX IF NOT EXISTS idx_scripts_provider ON scripts(provider, id);
+CREATE INDEX IF NOT EXISTS idx_scripts_created ON scripts(created_at);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS scripts_fts USING fts5(
+    script, content='scripts', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS scripts_ai AFTER INSERT ON scripts BEGIN
+    INSERT INTO scripts_fts(rowid, script) VALUES (new.id, new.script);
+END;
+CREATE TRIGGER IF NOT EXISTS scripts_ad AFTER DELETE ON scripts BEGIN
+    INSERT INTO scripts_fts(scripts_fts, rowid, script) VALUES ('delete', old.id, old.script);
+END;
+"""
+
+
+def _fts_query(query: str) -> Tuple[str | None, List[str]]:
+    """検索語を (FTS5 の MATCH 式, LIKE で探す短い語) に分ける。語はすべて AND"""
+    long_terms: List[str] = []
+    short_terms: List[str] = []
+    for term in query.split():
+        (long_terms if len(term) >= _MIN_FTS_CHARS else short_terms).append(term)
+    # 各語をフレーズとして引用し、FTS5 の演算子として解釈されないようにする
+    match = " ".join('"' + t.replace('"', '""') + '"' for t in long_terms) or None
+    return match, short_terms
+
+
+class HistoryStore:
+    """SQLite + FTS5 の生成履歴"""
+
+    def __init__(self, path: str = _HISTORY_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    # ── 書き込み ────────────────────────────────────────────────────────────
+    def add(
+        self,
+        req: Dict[str, Any],
+        scripts: List[Tuple[str, str | None, str]],
+        mode: str = "compare",
+        session_id: str | None = None,
+    ) -> int:
+        """1 リクエスト分を保存して request_id を返す。scripts は (provider, model, 台本) のリスト"""
+        now = time.time()
+        variations: Dict[str, int] = {}
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO requests (created_at, session_id, mode, product_name, request) VALUES (?, ?, ?, ?, ?)",
+                (now, session_id, mode, str(req.get("product_name", "")).strip(), json.dumps(req, ensure_ascii=False)),
+            )
+            request_id = cur.lastrowid
+            rows = []
+            for provider, model, script in scripts:
+                variations[provider] = variations.get(provider, 0) + 1
+                rows.append((request_id, now, provider, model, variations[provider], script))
+            self._conn.executemany(
+                "INSERT INTO scripts (request_id, created_at, provider, model, variation, script)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return request_id
+
+    # ── 読み込み ────────────────────────────────────────────────────────────
+    def _where(self, query: str, product_prefix: str | None, provider: str | None) -> Tuple[str, List[Any]]:
+        clauses: List[str] = []
+        params: List[Any] = []
+        match, short_terms = _fts_query(query)
+        if match:
+            clauses.append("s.id IN (SELECT rowid FROM scripts_fts WHERE scripts_fts MATCH ?)")
+            params.append(match)
+        for term in short_terms:
+            clauses.append("instr(s.script, ?) > 0")
+            params.append(term)
+        if product_prefix:
+            # LIKE 'x%' は既定の大文字小文字無視でインデックスを使えないため、範囲条件で前方一致させる
+            clauses.append("r.product_name >= ? AND r.product_name < ?")
+            params.extend([product_prefix, product_prefix + _PREFIX_END])
+        if provider:
+            clauses.append("s.provider = ?")
+            params.append(provider)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def search(
+        self,
+        query: str = "",
+        product_prefix: str | None = None,
+        provider: str | None = None,
+        before_id: int | None = None,
+        limit: int = 20,
+    ) -> List[Dict[str, Any]]:
+        """新しい順に 1 ページ分を返す。次のページは最後の行の id を before_id に渡す (キーセット方式)
+
+        product_prefix は商品名の前方一致 (idx_requests_product の範囲検索)。
+        本文は冒頭 _PREVIEW_CHARS 文字のみ。全文は get_script() で読む。
+        """
+        where, params = self._where(query, product_prefix, provider)
+        if before_id is not None:
+            where += (" AND " if where else " WHERE ") + "s.id < ?"
+            params.append(before_id)
+        sql = (
+            "SELECT s.id, s.request_id, s.created_at, s.provider, s.model, s.variation,"
+            " substr(s.script, 1, ?) AS preview, length(s.script) AS length, r.product_name, r.mode"
+            " FROM scripts s JOIN requests r ON r.id = s.request_id"
+            f"{where} ORDER BY s.id DESC LIMIT ?"
+        )
+        with self._lock:
+            rows = self._conn.execute(sql, [_PREVIEW_CHARS, *params, limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self, query: str = "", product_prefix: str | None = None, provider: str | None = None) -> int:
+        """検索条件に一致する台本の件数"""
+        where, params = self._where(query, product_prefix, provider)
+        sql = f"SELECT count(*) FROM scripts s JOIN requests r ON r.id = s.request_id{where}"
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()[0]
+
+    def get_script(self, script_id: int) -> Dict[str, Any] | None:
+        """台本 1 本の全文とリクエスト辞書"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT s.*, r.request FROM scripts s JOIN requests r ON r.id = s.request_id WHERE s.id = ?",
+                (script_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        record["request"] = json.loads(record["request"])
+        return record
+
+
+_store: HistoryStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_history() -> HistoryStore:
+    """プロセス全体で共有する履歴ストア (全 Streamlit セッション共通)"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = HistoryStore()
+        return _store
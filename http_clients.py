@@ -0,0 +1,48 @@
+import os
+from functools import lru_cache
+
+import httpx
+
+# ────────────────────────────────────────────────────────────────────────────
+# プロセス共通の HTTP クライアント (OpenAI / Anthropic SDK に http_client として渡す)
+#   - 同期版は app.py / batch.py のスレッドから、async 版は api_server.py から使う
+#   - keep-alive の接続を全 Streamlit セッションで使い回し、リクエストごとの TLS 接続を避ける
+#   - 接続プールの大きさとタイムアウトは環境変数で調整する
+#   接続数の上限は rate_limit の同時実行上限 (LLM_GLOBAL_MAX_INFLIGHT) 以上にしておくこと
+# ────────────────────────────────────────────────────────────────────────────
+
+_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "64"))
+_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "32"))
+_KEEPALIVE_EXPIRY_SEC = float(os.getenv("LLM_HTTP_KEEPALIVE_SEC", "60"))
+_CONNECT_TIMEOUT_SEC = float(os.getenv("LLM_HTTP_CONNECT_TIMEOUT_SEC", "10"))
+# ストリーミングでは「次のチャンクが届くまで」の待ち時間
+_READ_TIMEOUT_SEC = float(os.getenv("LLM_HTTP_READ_TIMEOUT_SEC", "120"))
+
+
+def http_timeout() -> httpx.Timeout:
+    """SDK にも同じ値を渡し、SDK 既定の長いタイムアウト (10 分) で上書きされないようにする"""
+    return httpx.Timeout(_READ_TIMEOUT_SEC, connect=_CONNECT_TIMEOUT_SEC)
+
+
+def read_timeout_sec() -> float:
+    return _READ_TIMEOUT_SEC
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=_MAX_CONNECTIONS,
+        max_keepalive_connections=_MAX_KEEPALIVE,
+        keepalive_expiry=_KEEPALIVE_EXPIRY_SEC,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_http_client(provider: str) -> httpx.Client:
+    """プロバイダーごとに 1 つの接続プール (あるプロバイダーの遅延が他の接続を塞がないよう分ける)"""
+    return httpx.Client(limits=_limits(), timeout=http_timeout())
+
+
+@lru_cache(maxsize=None)
+def get_async_http_client(provider: str) -> httpx.AsyncClient:
+    """api_server 用の async 版。接続は最初に使ったイベントループに属するため、ループは 1 つに限る"""
+    return httpx.AsyncClient(limits=_limits(), timeout=http_timeout())
@@ -0,0 +1,225 @@
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Tuple
+
+from fanout import GenerateFn, StreamFn, bind_context, fan_out_stream
+from hedge import fastest_first
+from history import get_history
+from providers import get_model_name
+import metrics
+from streaming import StreamEvent
+
+# ────────────────────────────────────────────────────────────────────────────
+# バックグラウンド生成ジョブ
+#   - 「台本を生成」は submit() でジョブを積んで job_id を受け取るだけ
+#   - ジョブごとに専用スレッドが fan_out_stream を回し、届いた差分をジョブへ書き込む
+#     (ジョブ単位の待ち行列は作らない。外部への同時呼び出し数とセッション間の公平性は
+#      rate_limit の FairScheduler / LLM_GLOBAL_MAX_INFLIGHT が呼び出し単位で制御する)
+#   - Streamlit の再実行 (サイドバー操作など) でスクリプトが中断されても生成は続き、
+#     UI は st.session_state の job_id から snapshot() を読み直して描画する
+#   - 完了したジョブの台本は history へ保存する (エラー・途中で失敗したストリームの書きかけは除く)
+# ────────────────────────────────────────────────────────────────────────────
+
+# 完了したジョブを保持する秒数
+_TTL_SEC = int(os.getenv("AD_JOB_TTL_SEC", "3600"))
+
+# 最速 N 本モードのジョブで、providers / texts のキーに使う名前
+FASTEST = "Fastest"
+
+
+class Job:
+    """1 回の「台本を生成」分の状態。ワーカーが書き込み、UI は snapshot() で読む"""
+
+    def __init__(self, req: Dict[str, Any], providers: List[str], models: Dict[str, str] | None = None):
+        self.id = uuid.uuid4().hex
+        self.req = req
+        self.providers = providers
+        # ルーターで選んだプロバイダーごとのモデル (無ければ各モジュールの既定)
+        self.models: Dict[str, str] = models or {}
+        self.status = "queued"  # queued → running → done
+        self.created_at = time.time()
+        self.finished_at: float | None = None
+
+        n = int(req.get("n_variations", 1))
+        self.texts: Dict[str, List[str]] = {p: [""] * n for p in providers}
+        self.finished: Dict[str, int] = {p: 0 for p in providers}
+        # "done" イベントを受け取ったバリエーション (履歴へ保存するのはこれだけ)
+        self._completed: Dict[str, set[int]] = {p: set() for p in providers}
+        self.errors: Dict[str, str] = {}  # バリエーションに紐づかないエラー
+        # 各枠の見出し (最速 N 本モードで、どのプロバイダーの結果かを示す)
+        self.titles: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            self.status = "running"
+
+    def apply(self, provider: str, event: StreamEvent) -> None:
+        """fan_out_stream のイベントを反映 (app.py で直接描画していたときと同じ規則)"""
+        with self._lock:
+            if event.index < 0:
+                self.errors[provider] = event.text
+            elif event.kind == "delta":
+                self.texts[provider][event.index] += event.text
+            else:  # "done" / "error"
+                self.texts[provider][event.index] = event.text
+                self.finished[provider] += 1
+                if event.kind == "done":
+                    self._completed[provider].add(event.index)
+
+    def completed_scripts(self) -> List[Tuple[str, str]]:
+        """完成した (provider, 台本)。ストリームが途中で失敗したバリエーションの書きかけは含めない"""
+        with self._lock:
+            return [(p, self.texts[p][i]) for p in self.providers for i in sorted(self._completed[p])]
+
+    def set_results(self, key: str, results: List[Tuple[str, str]]) -> None:
+        """(見出し, 台本) のリストで key の枠をまとめて埋める"""
+        with self._lock:
+            self.titles[key] = [title for title, _ in results]
+            self.texts[key] = [text for _, text in results]
+            self.finished[key] = len(results)
+
+    def finish(self) -> None:
+        with self._lock:
+            self.status = "done"
+            self.finished_at = time.time()
+
+    @property
+    def done(self) -> bool:
+        return self.status == "done"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """描画用のコピー (ワーカーが書き込み中でも一貫した状態を返す)"""
+        with self._lock:
+            return {
+                "id": self.id,
+                "req": self.req,
+                "providers": list(self.providers),
+                "status": self.status,
+                "texts": {p: list(t) for p, t in self.texts.items()},
+                "finished": dict(self.finished),
+                "errors": dict(self.errors),
+                "titles": {p: list(t) for p, t in self.titles.items()},
+                "models": dict(self.models),
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+            }
+
+
+class JobQueue:
+    """プロセス全体で共有するジョブキュー + 結果ストア"""
+
+    def __init__(self, ttl_sec: int = _TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _save_history(job: Job, scripts: List[Tuple[str, str]], mode: str) -> None:
+        """(provider, 台本) のうち成功したものを履歴へ保存"""
+        scripts = [(provider, script) for provider, script in scripts if script and not script.startswith("❌")]
+        if scripts:
+            get_history().add(
+                job.req,
+                [
+                    (provider, job.models.get(provider) or get_model_name(provider), script)
+                    for provider, script in scripts
+                ],
+                mode=mode,
+                session_id=metrics.session_id.get(),
+            )
+
+    def _run(self, job: Job, streamers: Dict[str, StreamFn]) -> None:
+        job.start()
+        try:
+            for provider, event in fan_out_stream(job.req, streamers):
+                job.apply(provider, event)
+            self._save_history(job, job.completed_scripts(), "compare")
+        finally:
+            job.finish()
+
+    def _run_fastest(
+        self,
+        job: Job,
+        generators: Dict[str, GenerateFn],
+        hedge_after_sec: float | None,
+        hedge_generators: Dict[str, GenerateFn] | None,
+    ) -> None:
+        job.start()
+        try:
+            results = fastest_first(
+                job.req, generators, hedge_after_sec=hedge_after_sec, hedge_generators=hedge_generators
+            )
+            job.set_results(
+                FASTEST,
+                [
+                    (
+                        f"{r.provider}{' (ヘッジ)' if r.hedged else ''} · {r.elapsed_sec:.1f} 秒"
+                        f"{'' if r.passed else ' · ⚠️ 文字数不足'}",
+                        r.script,
+                    )
+                    for r in results
+                ],
+            )
+            self._save_history(job, [(r.provider, r.script) for r in results], "fastest")
+        except Exception as e:
+            job.apply(FASTEST, StreamEvent(-1, "error", f"❌ Fastest Error: {e}"))
+        finally:
+            job.finish()
+
+    def _prune(self) -> None:
+        """保持期限を過ぎた完了済みジョブを削除"""
+        cutoff = time.time() - self.ttl_sec
+        with self._lock:
+            for job_id in [j.id for j in self._jobs.values() if j.done and j.finished_at < cutoff]:
+                del self._jobs[job_id]
+
+    def _enqueue(self, job: Job, target: Callable[..., None], *args: Any) -> str:
+        """呼び出し元の contextvars (metrics.session_id など) はワーカーへ引き継ぐ"""
+        self._prune()
+        with self._lock:
+            self._jobs[job.id] = job
+        # ジョブは I/O 待ちが大半なので 1 ジョブ 1 スレッドで即座に開始する
+        threading.Thread(
+            target=bind_context(target), args=(job, *args), name=f"ad-job-{job.id[:8]}", daemon=True
+        ).start()
+        return job.id
+
+    def submit(
+        self, req: Dict[str, Any], streamers: Dict[str, StreamFn], models: Dict[str, str] | None = None
+    ) -> str:
+        """比較モード: 全プロバイダーをストリーミングするジョブを積み、即座に job_id を返す"""
+        return self._enqueue(Job(req, list(streamers), models), self._run, streamers)
+
+    def submit_fastest(
+        self,
+        req: Dict[str, Any],
+        generators: Dict[str, GenerateFn],
+        hedge_after_sec: float | None = None,
+        hedge_generators: Dict[str, GenerateFn] | None = None,
+        models: Dict[str, str] | None = None,
+    ) -> str:
+        """最速 N 本モード: hedge.fastest_first を実行するジョブを積み、即座に job_id を返す"""
+        return self._enqueue(
+            Job(req, [FASTEST], models), self._run_fastest, generators, hedge_after_sec, hedge_generators
+        )
+
+    def get(self, job_id: str) -> Job | None:
+        """job_id のジョブ (期限切れ・別プロセスで見つからなければ None)"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+
+_queue: JobQueue | None = None
+_queue_lock = threading.Lock()
+
+
+def get_jobs() -> JobQueue:
+    """プロセス全体で共有するジョブキュー (全 Streamlit セッション共通)"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
@@ -0,0 +1,58 @@
+import math
+
+from prompt_utils import calc_char_count
+
+# ────────────────────────────────────────────────────────────────────────────
+# 台本の長さ判定 – 3 社共通
+#   - 目標は calc_char_count() の「文字数」なので、判定も文字数で行う
+#     (以前は呼び出しのたびに tiktoken で cl100k のトークン数を数え、文字数と比較していた)
+#   - 不足分だけを続き書きさせる際の max_tokens 見積もりに、
+#     プロバイダーが返す usage (出力トークン数) を利用する
+# ────────────────────────────────────────────────────────────────────────────
+
+# usage が取れない場合の 1 文字あたりトークン数の目安 (日本語)
+_DEFAULT_TOKENS_PER_CHAR = 1.2
+# 続き書きの max_tokens に持たせる余裕
+_EXTEND_HEADROOM = 1.5
+_MAX_OUTPUT_TOKENS = 4096
+
+
+def count_chars(text: str) -> int:
+    """台本の文字数 (空白・改行を除く)。calc_char_count の目標値と同じ単位"""
+    return sum(1 for ch in text if not ch.isspace())
+
+
+def target_chars(duration_sec: int) -> int:
+    """動画尺から必要な最低文字数"""
+    return calc_char_count(duration_sec)
+
+
+def missing_chars(text: str, target: int) -> int:
+    """目標まで不足している文字数 (足りていれば 0)"""
+    return max(0, target - count_chars(text))
+
+
+def tokens_per_char(text: str, output_tokens: int | None) -> float | None:
+    """usage の出力トークン数と実際の文字数から、1 文字あたりのトークン数を求める"""
+    chars = count_chars(text)
+    if not output_tokens or not chars:
+        return None
+    return output_tokens / chars
+
+
+def extension_max_tokens(missing: int, ratio: float | None = None) -> int:
+    """不足分 missing 文字を書かせるための max_tokens
+
+    ratio (tokens_per_char の実測値) があればそれで、なければ日本語の目安値で見積もる。
+    """
+    ratio = ratio or _DEFAULT_TOKENS_PER_CHAR
+    return min(_MAX_OUTPUT_TOKENS, max(256, math.ceil(missing * ratio * _EXTEND_HEADROOM)))
+
+
+def join_extension(text: str, extension: str) -> str:
+    """下書きと続き書きを連結"""
+    extension = extension.strip()
+    if not extension:
+        return text
+    return f"{text.rstrip()}\n{extension}"
+
@@ -1,33 +1,88 @@
+import asyncio
 import os
-from typing import List, Dict, Any
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, AsyncIterator, Iterator
 
 import anthropic
-import tiktoken
 # "prompt_utils.pyからテンプレートをインポート"
-from prompt_utils import build_prompt
+from prompt_utils import build_prompt_parts, build_extend_prompt_parts
+from length_utils import (
+    target_chars,
+    missing_chars,
+    tokens_per_char,
+    extension_max_tokens,
+    join_extension,
+)
+from streaming import StreamEvent
+from fanout import amerge_streams, merge_streams, bind_context
+from rate_limit import get_limiter, estimate_tokens
+from metrics import track, Span
+from http_clients import get_async_http_client, get_http_client, http_timeout
 
 # ────────────────────────────────────────────────────────────────────────────
-# Anthropic Claude 3.x – 広告台本生成モジュール
+# Anthropic Claude 3.x – 広告台本生成モジュール
 # ────────────────────────────────────────────────────────────────────────────
 
-_ANTHROPIC_API_KEY: str | None = os.getenv("ANTHROPIC_API_KEY")
-if not _ANTHROPIC_API_KEY:
-    raise EnvironmentError("ANTHROPIC_API_KEY is not set.")
-
-_client = anthropic.Anthropic(api_key=_ANTHROPIC_API_KEY)
-
 # デフォルトモデル（環境変数で上書き可）
 _MODEL_NAME = os.getenv("CLAUDE_MODEL", "claude-3-5-haiku-latest")
 
+# バリエーションを同時に生成する最大数（環境変数で上書き可）
+_MAX_CONCURRENCY = int(os.getenv("CLAUDE_MAX_CONCURRENCY", "5"))
+
+
+@lru_cache(maxsize=1)
+def _get_client() -> anthropic.Anthropic:
+    """クライアントは初回利用時に生成し、プロセス全体で使い回す"""
+    api_key: str | None = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise EnvironmentError("ANTHROPIC_API_KEY is not set.")
+    # リトライは rate_limit 側で一元管理するため SDK の自動リトライは無効化。
+    # HTTP 接続は http_clients の共有プール (keep-alive・タイムアウト設定済み) を使う
+    return anthropic.Anthropic(
+        api_key=api_key, max_retries=0, timeout=http_timeout(), http_client=get_http_client("Claude")
+    )
+
+
+def _request_kwargs(prompt_parts: tuple[str, str]) -> Dict[str, Any]:
+    """固定の prefix を cache_control 付きの system に、可変の suffix を user に置く
+
+    prefix はリクエスト間でバイト単位に同一なので、2 回目以降はキャッシュから読まれる。
+    """
+    prefix, suffix = prompt_parts
+    return {
+        "system": [{"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}],
+        "messages": [{"role": "user", "content": suffix}],
+    }
+
+
+def _set_usage(span: Span, usage: Any) -> None:
+    """usage を計測値へ反映。input_tokens はキャッシュ分を含まないため合算する"""
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    span.set_usage(usage.input_tokens + cache_read + cache_write, usage.output_tokens, cache_read)
+
+
+def _create(
+    model: str, prompt_parts: tuple[str, str], expected_chars: int, phase: str, **kwargs: Any
+) -> anthropic.types.Message:
+    """messages.create をレート制御・リトライ・計測付きで呼ぶ"""
+    with track("Claude", model, phase) as span:
+        message = get_limiter("Claude").call(
+            lambda: _get_client().messages.create(
+                model=model, **_request_kwargs(prompt_parts), **kwargs
+            ),
+            estimate_tokens("".join(prompt_parts), expected_chars),
+            span=span,
+        )
+        if message.usage:
+            _set_usage(span, message.usage)
+    return message
+
 # ────────────────────────────────────────────────────────────────────────────
 # Public API
 # ────────────────────────────────────────────────────────────────────────────
 
-def _count_tokens(text: str, model: str) -> int:
-    """指定モデルでのトークン数をカウント"""
-    enc = tiktoken.get_encoding("cl100k_base")
-    return len(enc.encode(text))
-
 def _extract_text_from_message(message_obj: anthropic.types.Message) -> str:
     """Message.content は TextBlock のリスト。すべて結合して 1 文字列へ"""
 
@@ -52,6 +107,7 @@ def generate_ad_claude(req: Dict[str, Any]) -> List[str]:
         app.py から渡されるリクエスト辞書。必須キーは:
         - product_name, problem, promise, tone (List[str]), audience_age,
           duration_sec, offer_price, n_variations, temperature
+        任意で model (既定モデルの上書き)
 
     Returns
     -------
@@ -59,46 +115,261 @@ def generate_ad_claude(req: Dict[str, Any]) -> List[str]:
         生成された台本文字列リスト (長さ = n_variations)
     """
 
+    model: str = req.get("model") or _MODEL_NAME
     n_variations: int = int(req.get("n_variations", 1))
     temperature: float = float(req.get("temperature", 0.9))
     duration_sec = int(req.get("duration_sec", 30))
-    min_tokens = int(duration_sec * 8)  # 1秒あたり8文字を目安に計算
+    min_chars = target_chars(duration_sec)
 
-    # プロンプト組み立て
-    prompt_text = build_prompt(req)
+    # プロンプト組み立て (キャッシュ可能な prefix + 可変の suffix)
+    prompt_parts = build_prompt_parts(req)
 
-    scripts: List[str] = []
-    for _ in range(n_variations):
-        message = _client.messages.create(
-            model=_MODEL_NAME,
+    def _generate_one(_: int) -> str:
+        """1 バリエーション分: 下書き → (必要なら) 不足分の続き書き"""
+        message = _create(
+            model,
+            prompt_parts,
+            min_chars,
+            "draft",
             max_tokens=4096,
             temperature=temperature,
-            messages=[
-                {"role": "user", "content": prompt_text},
-            ],
         )
-        
+
         text = _extract_text_from_message(message)
-        # 生成された台本のトークン数をカウント
-        tokens = _count_tokens(text, _MODEL_NAME)
-
-        if tokens < min_tokens:
-            refine_instructions = (
-                f"あなたは動画広告のプロコピーライターです。"
-                f"以下の台本を添削して、より再生回数が増えるような台本にしてください。"
-                f"また、{min_tokens}文字以上になるように、内容を増やしてください。"
-                f"出力は、添削後の台本のみを返してください。\n\n"
-                f"１分ごとに改行してください。\n\n"
-            )
-            refine_prompt = f"{refine_instructions}\n\n{text}"  # 元文 + 指示
-            refine_message = _client.messages.create(
-                model=_MODEL_NAME,
-                max_tokens=4096,
+
+        # 文字数が足りている場合は追加の呼び出しをしない
+        missing = missing_chars(text, min_chars)
+        if missing:
+            ratio = tokens_per_char(text, message.usage.output_tokens if message.usage else None)
+            extend_message = _create(
+                model,
+                build_extend_prompt_parts(text, missing),
+                missing,
+                "extend",
+                max_tokens=extension_max_tokens(missing, ratio),
                 temperature=temperature,
-                messages=[
-                    {"role": "user", "content": refine_prompt},
-                ],
             )
-            scripts.append(_extract_text_from_message(refine_message))
+            text = join_extension(text, _extract_text_from_message(extend_message))
+        return text
+
+    # バリエーションごとに並列実行。続き書きは自分の下書きが返った時点で開始する。
+    # map() は投入順で結果を返すため、並び順は安定
+    with ThreadPoolExecutor(max_workers=max(1, min(n_variations, _MAX_CONCURRENCY))) as executor:
+        return list(executor.map(bind_context(_generate_one), range(n_variations)))
+
+
+def _stream_text(
+    model: str,
+    prompt_parts: tuple[str, str],
+    temperature: float,
+    phase: str,
+    max_tokens: int = 4096,
+    usage: Dict[str, int] | None = None,
+    expected_chars: int = 0,
+) -> Iterator[str]:
+    """messages.stream でテキスト差分を逐次 yield。usage を渡すと出力トークン数を書き込む"""
+
+    def _open() -> Iterator[str]:
+        with _get_client().messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **_request_kwargs(prompt_parts),
+        ) as stream:
+            yield from stream.text_stream
+            final = stream.get_final_message()
+        if final.usage:
+            _set_usage(span, final.usage)
+            if usage is not None:
+                usage["output_tokens"] = final.usage.output_tokens
+
+    with track("Claude", model, phase) as span:
+        for delta in get_limiter("Claude").stream(
+            _open, estimate_tokens("".join(prompt_parts), expected_chars), span=span
+        ):
+            span.first_token()
+            yield delta
+
+
+def stream_ad_claude(req: Dict[str, Any]) -> Iterator[StreamEvent]:
+    """generate_ad_claude のストリーミング版。テキスト差分を StreamEvent で逐次返す"""
+
+    model: str = req.get("model") or _MODEL_NAME
+    n_variations: int = int(req.get("n_variations", 1))
+    temperature: float = float(req.get("temperature", 0.9))
+    duration_sec = int(req.get("duration_sec", 30))
+    min_chars = target_chars(duration_sec)
+
+    prompt_parts = build_prompt_parts(req)
+
+    def _stream_one(index: int) -> Iterator[StreamEvent]:
+        parts: List[str] = []
+        usage: Dict[str, int] = {}
+        for delta in _stream_text(model, prompt_parts, temperature, "draft", usage=usage, expected_chars=min_chars):
+            parts.append(delta)
+            yield StreamEvent(index, "delta", delta)
+
+        # 長さチェックは完成したテキストに対して行い、不足分の続きだけを追記する
+        text = "".join(parts).strip()
+        missing = missing_chars(text, min_chars)
+        if missing:
+            extension: List[str] = []
+            yield StreamEvent(index, "delta", "\n")
+            for delta in _stream_text(
+                model,
+                build_extend_prompt_parts(text, missing),
+                temperature,
+                "extend",
+                max_tokens=extension_max_tokens(missing, tokens_per_char(text, usage.get("output_tokens"))),
+                expected_chars=missing,
+            ):
+                extension.append(delta)
+                yield StreamEvent(index, "delta", delta)
+            text = join_extension(text, "".join(extension))
+        yield StreamEvent(index, "done", text)
+
+    yield from merge_streams(
+        [lambda index=index: _stream_one(index) for index in range(n_variations)],
+        max_workers=max(1, min(n_variations, _MAX_CONCURRENCY)),
+    )
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# async 版 (api_server.py 用)。1 つのイベントループ上で多数のリクエストを同時に捌く
+# ────────────────────────────────────────────────────────────────────────────
+
+@lru_cache(maxsize=1)
+def _get_async_client() -> anthropic.AsyncAnthropic:
+    """async クライアントも初回利用時に生成し、プロセス全体で使い回す"""
+    api_key: str | None = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise EnvironmentError("ANTHROPIC_API_KEY is not set.")
+    return anthropic.AsyncAnthropic(
+        api_key=api_key, max_retries=0, timeout=http_timeout(), http_client=get_async_http_client("Claude")
+    )
+
+
+async def _acreate(
+    model: str, prompt_parts: tuple[str, str], expected_chars: int, phase: str, **kwargs: Any
+) -> anthropic.types.Message:
+    """_create の async 版"""
+    with track("Claude", model, phase) as span:
+        message = await get_limiter("Claude").acall(
+            lambda: _get_async_client().messages.create(
+                model=model, **_request_kwargs(prompt_parts), **kwargs
+            ),
+            estimate_tokens("".join(prompt_parts), expected_chars),
+            span=span,
+        )
+        if message.usage:
+            _set_usage(span, message.usage)
+    return message
+
+
+async def agenerate_ad_claude(req: Dict[str, Any]) -> List[str]:
+    """generate_ad_claude の async 版"""
+    model: str = req.get("model") or _MODEL_NAME
+    n_variations: int = int(req.get("n_variations", 1))
+    temperature: float = float(req.get("temperature", 0.9))
+    min_chars = target_chars(int(req.get("duration_sec", 30)))
+    prompt_parts = build_prompt_parts(req)
+
+    # 同期版のスレッドプールと同じく、1 リクエスト内の同時実行数を抑える
+    semaphore = asyncio.Semaphore(max(1, _MAX_CONCURRENCY))
+
+    async def _generate_one() -> str:
+        async with semaphore:
+            message = await _acreate(model, prompt_parts, min_chars, "draft", max_tokens=4096, temperature=temperature)
+            text = _extract_text_from_message(message)
+
+            missing = missing_chars(text, min_chars)
+            if missing:
+                ratio = tokens_per_char(text, message.usage.output_tokens if message.usage else None)
+                extend_message = await _acreate(
+                    model,
+                    build_extend_prompt_parts(text, missing),
+                    missing,
+                    "extend",
+                    max_tokens=extension_max_tokens(missing, ratio),
+                    temperature=temperature,
+                )
+                text = join_extension(text, _extract_text_from_message(extend_message))
+            return text
+
+    return list(await asyncio.gather(*(_generate_one() for _ in range(n_variations))))
+
+
+async def _astream_text(
+    model: str,
+    prompt_parts: tuple[str, str],
+    temperature: float,
+    phase: str,
+    max_tokens: int = 4096,
+    usage: Dict[str, int] | None = None,
+    expected_chars: int = 0,
+) -> AsyncIterator[str]:
+    """_stream_text の async 版"""
+
+    async def _open() -> AsyncIterator[str]:
+        async with _get_async_client().messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **_request_kwargs(prompt_parts),
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            final = await stream.get_final_message()
+        if final.usage:
+            _set_usage(span, final.usage)
+            if usage is not None:
+                usage["output_tokens"] = final.usage.output_tokens
+
+    with track("Claude", model, phase) as span:
+        async for delta in get_limiter("Claude").astream(
+            _open, estimate_tokens("".join(prompt_parts), expected_chars), span=span
+        ):
+            span.first_token()
+            yield delta
+
+
+async def astream_ad_claude(req: Dict[str, Any]) -> AsyncIterator[StreamEvent]:
+    """stream_ad_claude の async 版"""
+    model: str = req.get("model") or _MODEL_NAME
+    n_variations: int = int(req.get("n_variations", 1))
+    temperature: float = float(req.get("temperature", 0.9))
+    min_chars = target_chars(int(req.get("duration_sec", 30)))
+    prompt_parts = build_prompt_parts(req)
+
+    async def _stream_one(index: int) -> AsyncIterator[StreamEvent]:
+        parts: List[str] = []
+        usage: Dict[str, int] = {}
+        async for delta in _astream_text(
+            model, prompt_parts, temperature, "draft", usage=usage, expected_chars=min_chars
+        ):
+            parts.append(delta)
+            yield StreamEvent(index, "delta", delta)
+
+        text = "".join(parts).strip()
+        missing = missing_chars(text, min_chars)
+        if missing:
+            extension: List[str] = []
+            yield StreamEvent(index, "delta", "\n")
+            async for delta in _astream_text(
+                model,
+                build_extend_prompt_parts(text, missing),
+                temperature,
+                "extend",
+                max_tokens=extension_max_tokens(missing, tokens_per_char(text, usage.get("output_tokens"))),
+                expected_chars=missing,
+            ):
+                extension.append(delta)
+                yield StreamEvent(index, "delta", delta)
+            text = join_extension(text, "".join(extension))
+        yield StreamEvent(index, "done", text)
 
-    return scripts
+    async for event in amerge_streams(
+        [lambda index=index: _stream_one(index) for index in range(n_variations)],
+        max_concurrency=max(1, min(n_variations, _MAX_CONCURRENCY)),
+    ):
+        yield event
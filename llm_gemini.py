@@ -1,81 +1,398 @@
+import asyncio
 import os
-from typing import List, Dict, Any
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, AsyncIterator, Iterator
 
 import google.generativeai as genai
-import tiktoken
 # "prompt_utils.pyからテンプレートをインポート"
-from prompt_utils import build_prompt
+from prompt_utils import build_prompt_parts, build_extend_prompt_parts
+from length_utils import (
+    target_chars,
+    missing_chars,
+    tokens_per_char,
+    extension_max_tokens,
+    join_extension,
+)
+from streaming import StreamEvent
+from fanout import amerge_streams, merge_streams, bind_context
+from rate_limit import get_limiter, estimate_tokens
+from metrics import track, Span
+from http_clients import read_timeout_sec
 
 # ────────────────────────────────────────────────────────────────────────────
-# Google Gemini 1.5 Flash / Pro – 広告台本生成モジュール
+# Google Gemini 1.5 Flash / Pro – 広告台本生成モジュール
 # ────────────────────────────────────────────────────────────────────────────
 
-_GEMINI_API_KEY: str | None = os.getenv("GOOGLE_GEMINI_API_KEY")
-if not _GEMINI_API_KEY:
-    raise EnvironmentError("GOOGLE_GEMINI_API_KEY is not set.")
+# 利用モデル（環境変数 GEMINI_MODEL、またはリクエストの model で flash / pro を切り替え）
+_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-1.5-flash-latest")
 
-genai.configure(api_key=_GEMINI_API_KEY)
+# バリエーションを同時に生成する最大数（環境変数で上書き可）
+_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "5"))
 
-# 利用モデル（必要に応じて flash / pro を切り替え）
-_MODEL_NAME = "gemini-1.5-flash-latest"
 
-def _count_tokens(text: str, model: str) -> int:
-    """指定モデルでのトークン数をカウント"""
-    enc = tiktoken.get_encoding("cl100k_base")
-    return len(enc.encode(text))
+@lru_cache(maxsize=1)
+def _configure() -> None:
+    """API キー設定は初回利用時に 1 回だけ行う
+
+    SDK はこの設定から作ったクライアント (gRPC チャネル / REST セッション) をプロセス全体で
+    使い回すため、接続は keep-alive される。httpx を差し込む口は無いので、
+    タイムアウトは呼び出しごとの request_options で http_clients と揃える。
+    """
+    api_key: str | None = os.getenv("GOOGLE_GEMINI_API_KEY")
+    if not api_key:
+        raise EnvironmentError("GOOGLE_GEMINI_API_KEY is not set.")
+    endpoint = os.getenv("GEMINI_API_ENDPOINT")
+    if endpoint:
+        # ローカルのスタブサーバー等へ向ける場合は REST トランスポートで接続
+        genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": endpoint})
+    else:
+        genai.configure(api_key=api_key)
+
+
+@lru_cache(maxsize=8)
+def _get_model(model_name: str = _MODEL_NAME) -> genai.GenerativeModel:
+    """モデルごとに初回利用時に生成し、プロセス全体で使い回す"""
+    _configure()
+    return genai.GenerativeModel(model_name)
+
+
+def _model_name(model: genai.GenerativeModel) -> str:
+    """計測用のモデル名 ("models/" 接頭辞を除く)"""
+    return model.model_name.removeprefix("models/")
+
+
+def _output_tokens(response) -> int | None:
+    """usage_metadata から出力トークン数を取り出す (無ければ None)"""
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "candidates_token_count", None) or None
+
+
+def _record_usage(span: Span, response) -> None:
+    """usage_metadata があれば計測値へ反映"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        span.set_usage(
+            getattr(usage, "prompt_token_count", None),
+            _output_tokens(response),
+            getattr(usage, "cached_content_token_count", None),
+        )
+
+
+def _generate(
+    model: genai.GenerativeModel, prompt_parts: tuple[str, str], est_chars: int, phase: str, **kwargs: Any
+):
+    """generate_content をレート制御・リトライ・計測付きで呼ぶ
+
+    固定の prefix を先頭のパートに置き、暗黙的なコンテキストキャッシュに乗せる。
+    """
+    with track("Gemini", _model_name(model), phase) as span:
+        response = get_limiter("Gemini").call(
+            lambda: model.generate_content(
+                list(prompt_parts), request_options={"timeout": read_timeout_sec()}, **kwargs
+            ),
+            estimate_tokens("".join(prompt_parts), est_chars),
+            span=span,
+        )
+        _record_usage(span, response)
+    return response
 
 # ---------------------------------------------------------------------------
-# Public API – generate_ad_gemini
+# Public API – generate_ad_gemini
 # ---------------------------------------------------------------------------
 
 def generate_ad_gemini(req: Dict[str, Any]) -> List[str]:
-    """Gemini で広告台本を n_variations 生成し、Markdown 文字列を返す。"""
+    """Gemini で広告台本を n_variations 生成し、Markdown 文字列を返す。req["model"] でモデルを上書きできる"""
+
+    model = _get_model(req.get("model") or _MODEL_NAME)
 
-    model = genai.GenerativeModel(_MODEL_NAME)
-    
     duration_sec = int(req.get("duration_sec", 30))
-    min_tokens = int(duration_sec * 8)  # 1秒あたり8文字を目安に計算
+    min_chars = target_chars(duration_sec)
+
+    # プロンプト組み立て (キャッシュ可能な prefix + 可変の suffix)
+    prompt_parts = build_prompt_parts(req)
 
-    # プロンプト組み立て
-    prompt_text = build_prompt(req)
+    n_variations = int(req.get("n_variations", 1))
 
-    scripts: List[str] = []
-    for _ in range(req.get("n_variations", 1)):
+    def _generate_one(_: int) -> str:
+        """1 バリエーション分: 下書き → (必要なら) 不足分の続き書き"""
         try:
-            response = model.generate_content(
-                [prompt_text],
+            response = _generate(
+                model,
+                prompt_parts,
+                min_chars,
+                "draft",
                 generation_config={
                     "temperature": req.get("temperature", 0.9),
                     "top_p": 0.95,
                     "max_output_tokens": 4096,
                 },
             )
-            
+
             text = response.text.strip()
-            tokens = _count_tokens(text, _MODEL_NAME)
-
-            if tokens < min_tokens:
-                refine_instructions = (
-                    f"あなたは動画広告のプロコピーライターです。"
-                    f"以下の台本を添削して、より再生回数が増えるような台本にしてください。"
-                    f"また、{min_tokens}文字以上になるように、内容を増やしてください。"
-                    f"出力は、添削後の台本のみを返してください。\n\n"
-                    f"１分ごとに改行してください。\n\n"
-                )
-                refine_prompt = f"{refine_instructions}\n\n{text}"  # 元文 + 指示
-                refine_resp = model.generate_content(
-                    [refine_prompt],
+
+            # 文字数が足りている場合は追加の呼び出しをしない
+            missing = missing_chars(text, min_chars)
+            if missing:
+                extend_resp = _generate(
+                    model,
+                    build_extend_prompt_parts(text, missing),
+                    missing,
+                    "extend",
                     generation_config={
                         "temperature": req.get("temperature", 0.9),
                         "top_p": 0.95,
-                        "max_output_tokens": 4096,
+                        "max_output_tokens": extension_max_tokens(
+                            missing, tokens_per_char(text, _output_tokens(response))
+                        ),
                     },
                 )
-                scripts.append(refine_resp.text.strip())
-            else:
-                scripts.append(text)
+                text = join_extension(text, extend_resp.text)
+            return text
+
+        except Exception as e:
+            return f"❌ Gemini Error: {e}"
+
+    # バリエーションごとに並列実行。続き書きは自分の下書きが返った時点で開始する。
+    # map() は投入順で結果を返すため、並び順は安定
+    with ThreadPoolExecutor(max_workers=max(1, min(n_variations, _MAX_CONCURRENCY))) as executor:
+        return list(executor.map(bind_context(_generate_one), range(n_variations)))
+
+
+def _stream_text(
+    model: genai.GenerativeModel,
+    prompt_parts: tuple[str, str],
+    temperature: float,
+    phase: str,
+    max_tokens: int = 4096,
+    usage: Dict[str, int] | None = None,
+    expected_chars: int = 0,
+) -> Iterator[str]:
+    """generate_content(stream=True) でテキスト差分を逐次 yield。usage を渡すと出力トークン数を書き込む"""
+
+    def _open() -> Iterator[str]:
+        response = model.generate_content(
+            list(prompt_parts),
+            generation_config={
+                "temperature": temperature,
+                "top_p": 0.95,
+                "max_output_tokens": max_tokens,
+            },
+            stream=True,
+            request_options={"timeout": read_timeout_sec()},
+        )
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+            # usage_metadata は最後のチャンクほど正確 (累計値)
+            if _output_tokens(chunk):
+                _record_usage(span, chunk)
+                if usage is not None:
+                    usage["output_tokens"] = _output_tokens(chunk)
+
+    with track("Gemini", _model_name(model), phase) as span:
+        for delta in get_limiter("Gemini").stream(
+            _open, estimate_tokens("".join(prompt_parts), expected_chars), span=span
+        ):
+            span.first_token()
+            yield delta
+
+
+def stream_ad_gemini(req: Dict[str, Any]) -> Iterator[StreamEvent]:
+    """generate_ad_gemini のストリーミング版。テキスト差分を StreamEvent で逐次返す"""
+
+    model = _get_model(req.get("model") or _MODEL_NAME)
+
+    duration_sec = int(req.get("duration_sec", 30))
+    min_chars = target_chars(duration_sec)
+    temperature = req.get("temperature", 0.9)
+
+    prompt_parts = build_prompt_parts(req)
+
+    n_variations = int(req.get("n_variations", 1))
+
+    def _stream_one(index: int) -> Iterator[StreamEvent]:
+        try:
+            parts: List[str] = []
+            usage: Dict[str, int] = {}
+            for delta in _stream_text(
+                model, prompt_parts, temperature, "draft", usage=usage, expected_chars=min_chars
+            ):
+                parts.append(delta)
+                yield StreamEvent(index, "delta", delta)
+
+            # 長さチェックは完成したテキストに対して行い、不足分の続きだけを追記する
+            text = "".join(parts).strip()
+            missing = missing_chars(text, min_chars)
+            if missing:
+                extension: List[str] = []
+                yield StreamEvent(index, "delta", "\n")
+                for delta in _stream_text(
+                    model,
+                    build_extend_prompt_parts(text, missing),
+                    temperature,
+                    "extend",
+                    max_tokens=extension_max_tokens(missing, tokens_per_char(text, usage.get("output_tokens"))),
+                    expected_chars=missing,
+                ):
+                    extension.append(delta)
+                    yield StreamEvent(index, "delta", delta)
+                text = join_extension(text, "".join(extension))
+            yield StreamEvent(index, "done", text)
+
+        except Exception as e:
+            yield StreamEvent(index, "error", f"❌ Gemini Error: {e}")
+
+    yield from merge_streams(
+        [lambda index=index: _stream_one(index) for index in range(n_variations)],
+        max_workers=max(1, min(n_variations, _MAX_CONCURRENCY)),
+    )
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# async 版 (api_server.py 用)。generate_content_async は gRPC の asyncio トランスポートを使う
+# ────────────────────────────────────────────────────────────────────────────
+
+async def _agenerate(
+    model: genai.GenerativeModel, prompt_parts: tuple[str, str], est_chars: int, phase: str, **kwargs: Any
+):
+    """_generate の async 版"""
+    with track("Gemini", _model_name(model), phase) as span:
+        response = await get_limiter("Gemini").acall(
+            lambda: model.generate_content_async(
+                list(prompt_parts), request_options={"timeout": read_timeout_sec()}, **kwargs
+            ),
+            estimate_tokens("".join(prompt_parts), est_chars),
+            span=span,
+        )
+        _record_usage(span, response)
+    return response
+
+
+async def agenerate_ad_gemini(req: Dict[str, Any]) -> List[str]:
+    """generate_ad_gemini の async 版"""
+    model = _get_model(req.get("model") or _MODEL_NAME)
+    min_chars = target_chars(int(req.get("duration_sec", 30)))
+    prompt_parts = build_prompt_parts(req)
+    n_variations = int(req.get("n_variations", 1))
+    temperature = req.get("temperature", 0.9)
+    semaphore = asyncio.Semaphore(max(1, _MAX_CONCURRENCY))
+
+    async def _generate_one() -> str:
+        try:
+            async with semaphore:
+                response = await _agenerate(
+                    model,
+                    prompt_parts,
+                    min_chars,
+                    "draft",
+                    generation_config={"temperature": temperature, "top_p": 0.95, "max_output_tokens": 4096},
+                )
+                text = response.text.strip()
+
+                missing = missing_chars(text, min_chars)
+                if missing:
+                    extend_resp = await _agenerate(
+                        model,
+                        build_extend_prompt_parts(text, missing),
+                        missing,
+                        "extend",
+                        generation_config={
+                            "temperature": temperature,
+                            "top_p": 0.95,
+                            "max_output_tokens": extension_max_tokens(
+                                missing, tokens_per_char(text, _output_tokens(response))
+                            ),
+                        },
+                    )
+                    text = join_extension(text, extend_resp.text)
+                return text
+
+        except Exception as e:
+            return f"❌ Gemini Error: {e}"
+
+    return list(await asyncio.gather(*(_generate_one() for _ in range(n_variations))))
+
+
+async def _astream_text(
+    model: genai.GenerativeModel,
+    prompt_parts: tuple[str, str],
+    temperature: float,
+    phase: str,
+    max_tokens: int = 4096,
+    usage: Dict[str, int] | None = None,
+    expected_chars: int = 0,
+) -> AsyncIterator[str]:
+    """_stream_text の async 版 (generate_content_async(stream=True))"""
+
+    async def _open() -> AsyncIterator[str]:
+        response = await model.generate_content_async(
+            list(prompt_parts),
+            generation_config={
+                "temperature": temperature,
+                "top_p": 0.95,
+                "max_output_tokens": max_tokens,
+            },
+            stream=True,
+            request_options={"timeout": read_timeout_sec()},
+        )
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+            if _output_tokens(chunk):
+                _record_usage(span, chunk)
+                if usage is not None:
+                    usage["output_tokens"] = _output_tokens(chunk)
+
+    with track("Gemini", _model_name(model), phase) as span:
+        async for delta in get_limiter("Gemini").astream(
+            _open, estimate_tokens("".join(prompt_parts), expected_chars), span=span
+        ):
+            span.first_token()
+            yield delta
+
+
+async def astream_ad_gemini(req: Dict[str, Any]) -> AsyncIterator[StreamEvent]:
+    """stream_ad_gemini の async 版"""
+    model = _get_model(req.get("model") or _MODEL_NAME)
+    min_chars = target_chars(int(req.get("duration_sec", 30)))
+    temperature = req.get("temperature", 0.9)
+    prompt_parts = build_prompt_parts(req)
+    n_variations = int(req.get("n_variations", 1))
+
+    async def _stream_one(index: int) -> AsyncIterator[StreamEvent]:
+        try:
+            parts: List[str] = []
+            usage: Dict[str, int] = {}
+            async for delta in _astream_text(
+                model, prompt_parts, temperature, "draft", usage=usage, expected_chars=min_chars
+            ):
+                parts.append(delta)
+                yield StreamEvent(index, "delta", delta)
+
+            text = "".join(parts).strip()
+            missing = missing_chars(text, min_chars)
+            if missing:
+                extension: List[str] = []
+                yield StreamEvent(index, "delta", "\n")
+                async for delta in _astream_text(
+                    model,
+                    build_extend_prompt_parts(text, missing),
+                    temperature,
+                    "extend",
+                    max_tokens=extension_max_tokens(missing, tokens_per_char(text, usage.get("output_tokens"))),
+                    expected_chars=missing,
+                ):
+                    extension.append(delta)
+                    yield StreamEvent(index, "delta", delta)
+                text = join_extension(text, "".join(extension))
+            yield StreamEvent(index, "done", text)
 
         except Exception as e:
-            scripts.append(f"❌ Gemini Error: {e}")
+            yield StreamEvent(index, "error", f"❌ Gemini Error: {e}")
 
-    return scripts
+    async for event in amerge_streams(
+        [lambda index=index: _stream_one(index) for index in range(n_variations)],
+        max_concurrency=max(1, min(n_variations, _MAX_CONCURRENCY)),
+    ):
+        yield event
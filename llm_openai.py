@@ -1,72 +1,375 @@
+import asyncio
 import os
-from typing import List, Dict, Any
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, AsyncIterator, Iterator
 
-from openai import OpenAI
-import tiktoken
+from openai import AsyncOpenAI, OpenAI
 
 # "prompt_utils.pyからテンプレートをインポート"
-from prompt_utils import build_prompt
+from prompt_utils import build_prompt_parts, build_extend_prompt_parts
+from length_utils import (
+    target_chars,
+    missing_chars,
+    tokens_per_char,
+    extension_max_tokens,
+    join_extension,
+)
+from streaming import StreamEvent
+from fanout import amerge_streams, merge_streams, bind_context
+from rate_limit import get_limiter, estimate_tokens
+from metrics import track, Span
+from http_clients import get_async_http_client, get_http_client, http_timeout
 
 # ────────────────────────────────────────────────────────────────────────────
 # OpenAI GPT‑4o / GPT‑4o‑mini – 動画広告台本生成モジュール
 # ────────────────────────────────────────────────────────────────────────────
 
-_OPENAI_API_KEY: str | None = os.getenv("OPENAI_API_KEY")
-if not _OPENAI_API_KEY:
-    raise EnvironmentError("OPENAI_API_KEY is not set.")
-
-_client = OpenAI(api_key=_OPENAI_API_KEY)
-
 # デフォルトモデルはコスト効率の良い gpt‑4o‑mini
 _MODEL_NAME = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
-def _count_tokens(text: str, model: str) -> int:
-    """指定モデルでのトークン数をカウント"""
-    enc = tiktoken.encoding_for_model(model)
-    return len(enc.encode(text))
+
+@lru_cache(maxsize=1)
+def _get_client() -> OpenAI:
+    """クライアントは初回利用時に生成し、プロセス全体で使い回す"""
+    api_key: str | None = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise EnvironmentError("OPENAI_API_KEY is not set.")
+    # リトライは rate_limit 側で一元管理するため SDK の自動リトライは無効化。
+    # HTTP 接続は http_clients の共有プール (keep-alive・タイムアウト設定済み) を使う
+    return OpenAI(
+        api_key=api_key, max_retries=0, timeout=http_timeout(), http_client=get_http_client("OpenAI")
+    )
+
+
+def _messages(prompt_parts: tuple[str, str]) -> List[Dict[str, str]]:
+    """固定の prefix を system、可変の suffix を user に分けて送る
+
+    prefix が先頭でバイト単位に一致するため、OpenAI の自動プロンプトキャッシュが効く。
+    """
+    prefix, suffix = prompt_parts
+    return [{"role": "system", "content": prefix}, {"role": "user", "content": suffix}]
+
+
+def _set_usage(span: Span, usage: Any) -> None:
+    """usage (キャッシュ済み入力トークン数を含む) を計測値へ反映"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    span.set_usage(usage.prompt_tokens, usage.completion_tokens, getattr(details, "cached_tokens", None))
+
+
+def _create(model: str, prompt_parts: tuple[str, str], expected_chars: int, phase: str, **kwargs: Any):
+    """chat.completions.create をレート制御・リトライ・計測付きで呼ぶ"""
+    with track("OpenAI", model, phase, kwargs.get("n", 1)) as span:
+        resp = get_limiter("OpenAI").call(
+            lambda: _get_client().chat.completions.create(
+                model=model, messages=_messages(prompt_parts), **kwargs
+            ),
+            estimate_tokens("".join(prompt_parts), expected_chars),
+            span=span,
+        )
+        if resp.usage:
+            _set_usage(span, resp.usage)
+    return resp
+
 # ────────────────────────────────────────────────────────────────────────────
 # Public API
 # ────────────────────────────────────────────────────────────────────────────
 
+def _extend(model: str, text: str, min_chars: int, temperature: float, ratio: float | None) -> str:
+    """文字数が足りない場合のみ、不足分の続きを生成して連結する"""
+    missing = missing_chars(text, min_chars)
+    if not missing:
+        return text
+
+    extend_resp = _create(
+        model,
+        build_extend_prompt_parts(text, missing),
+        missing,
+        "extend",
+        temperature=temperature,
+        top_p=0.95,
+        max_tokens=extension_max_tokens(missing, ratio),
+    )
+    return join_extension(text, extend_resp.choices[0].message.content or "")
+
+
 def generate_ad_openai(req: Dict[str, Any]) -> List[str]:
-    """OpenAI で広告台本を n_variations 分生成して返す"""
+    """OpenAI で広告台本を n_variations 分生成して返す。req["model"] でモデルを上書きできる"""
+    model = req.get("model") or _MODEL_NAME
     n_variations = int(req.get("n_variations", 1))
     temperature = float(req.get("temperature", 0.9))
     duration_sec = int(req.get("duration_sec", 30))
-    min_tokens = int(duration_sec * 8)  # 1秒あたり8文字を目安に計算
+    min_chars = target_chars(duration_sec)
+
+    # プロンプト組み立て (キャッシュ可能な prefix + 可変の suffix)
+    prompt_parts = build_prompt_parts(req)
+
+    initial_resp = _create(
+        model,
+        prompt_parts,
+        min_chars * n_variations,
+        "draft",
+        temperature=temperature,
+        top_p=0.95,
+        n=n_variations,
+        max_tokens=4096,
+    )
+    drafts = [(choice.message.content or "").strip() for choice in initial_resp.choices]
+
+    # usage は n 本分の合計なので、全下書きの合計文字数で割って比率を出す
+    output_tokens = initial_resp.usage.completion_tokens if initial_resp.usage else None
+    ratio = tokens_per_char("".join(drafts), output_tokens)
+
+    # 2. 各バリエーションをチェックし、不足分だけ続きを書かせる (並列)
+    with ThreadPoolExecutor(max_workers=max(1, len(drafts))) as executor:
+        return list(executor.map(bind_context(lambda text: _extend(model, text, min_chars, temperature, ratio)), drafts))
+
+
+def _stream_chat(
+    model: str,
+    prompt_parts: tuple[str, str],
+    temperature: float,
+    phase: str,
+    n: int = 1,
+    max_tokens: int = 4096,
+    usage: Dict[str, int] | None = None,
+    expected_chars: int = 0,
+) -> Iterator[tuple[int, str]]:
+    """chat.completions をストリーミングで呼び出し、(choice index, 差分) を yield"""
+
+    def _open(span: Span) -> Iterator[tuple[int, str]]:
+        stream = _get_client().chat.completions.create(
+            model=model,
+            messages=_messages(prompt_parts),
+            temperature=temperature,
+            top_p=0.95,
+            n=n,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},  # 最後のチャンクに usage が付く
+        )
+        for chunk in stream:
+            if chunk.usage:
+                _set_usage(span, chunk.usage)
+                if usage is not None:
+                    usage["output_tokens"] = chunk.usage.completion_tokens
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    yield choice.index, choice.delta.content
+
+    with track("OpenAI", model, phase, n) as span:
+        for item in get_limiter("OpenAI").stream(
+            lambda: _open(span), estimate_tokens("".join(prompt_parts), expected_chars), span=span
+        ):
+            span.first_token()
+            yield item
+
+
+def stream_ad_openai(req: Dict[str, Any]) -> Iterator[StreamEvent]:
+    """generate_ad_openai のストリーミング版。テキスト差分を StreamEvent で逐次返す"""
+    model = req.get("model") or _MODEL_NAME
+    n_variations = int(req.get("n_variations", 1))
+    temperature = float(req.get("temperature", 0.9))
+    duration_sec = int(req.get("duration_sec", 30))
+    min_chars = target_chars(duration_sec)
+
+    prompt_parts = build_prompt_parts(req)
 
-    # プロンプト組み立て
-    prompt_text = build_prompt(req)
+    # n 本のバリエーションは 1 本のストリームに choice index 付きで混在して届く
+    parts: List[List[str]] = [[] for _ in range(n_variations)]
+    usage: Dict[str, int] = {}
+    for index, delta in _stream_chat(
+        model,
+        prompt_parts, temperature, "draft", n=n_variations, usage=usage, expected_chars=min_chars * n_variations
+    ):
+        parts[index].append(delta)
+        yield StreamEvent(index, "delta", delta)
 
-    initial_resp = _client.chat.completions.create(
-        model=_MODEL_NAME,
-        messages=[{"role": "user", "content": prompt_text}],
+    drafts = ["".join(chunks).strip() for chunks in parts]
+    # generate_ad_openai と同じく、n 本分の usage と全下書きの文字数から比率を出す
+    ratio = tokens_per_char("".join(drafts), usage.get("output_tokens"))
+
+    def _extend_one(index: int, text: str) -> Iterator[StreamEvent]:
+        # 長さチェックは完成したテキストに対して行い、不足分の続きだけを追記する
+        missing = missing_chars(text, min_chars)
+        if missing:
+            extension: List[str] = []
+            yield StreamEvent(index, "delta", "\n")
+            for _, delta in _stream_chat(
+                model,
+                build_extend_prompt_parts(text, missing),
+                temperature,
+                "extend",
+                max_tokens=extension_max_tokens(missing, ratio),
+                expected_chars=missing,
+            ):
+                extension.append(delta)
+                yield StreamEvent(index, "delta", delta)
+            text = join_extension(text, "".join(extension))
+        yield StreamEvent(index, "done", text)
+
+    yield from merge_streams(
+        [lambda index=index, text=text: _extend_one(index, text) for index, text in enumerate(drafts)]
+    )
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# async 版 (api_server.py 用)。1 つのイベントループ上で多数のリクエストを同時に捌く
+# ────────────────────────────────────────────────────────────────────────────
+
+@lru_cache(maxsize=1)
+def _get_async_client() -> AsyncOpenAI:
+    """async クライアントも初回利用時に生成し、プロセス全体で使い回す"""
+    api_key: str | None = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise EnvironmentError("OPENAI_API_KEY is not set.")
+    return AsyncOpenAI(
+        api_key=api_key, max_retries=0, timeout=http_timeout(), http_client=get_async_http_client("OpenAI")
+    )
+
+
+async def _acreate(model: str, prompt_parts: tuple[str, str], expected_chars: int, phase: str, **kwargs: Any):
+    """_create の async 版"""
+    with track("OpenAI", model, phase, kwargs.get("n", 1)) as span:
+        resp = await get_limiter("OpenAI").acall(
+            lambda: _get_async_client().chat.completions.create(
+                model=model, messages=_messages(prompt_parts), **kwargs
+            ),
+            estimate_tokens("".join(prompt_parts), expected_chars),
+            span=span,
+        )
+        if resp.usage:
+            _set_usage(span, resp.usage)
+    return resp
+
+
+async def _aextend(model: str, text: str, min_chars: int, temperature: float, ratio: float | None) -> str:
+    """_extend の async 版"""
+    missing = missing_chars(text, min_chars)
+    if not missing:
+        return text
+
+    extend_resp = await _acreate(
+        model,
+        build_extend_prompt_parts(text, missing),
+        missing,
+        "extend",
+        temperature=temperature,
+        top_p=0.95,
+        max_tokens=extension_max_tokens(missing, ratio),
+    )
+    return join_extension(text, extend_resp.choices[0].message.content or "")
+
+
+async def agenerate_ad_openai(req: Dict[str, Any]) -> List[str]:
+    """generate_ad_openai の async 版"""
+    model = req.get("model") or _MODEL_NAME
+    n_variations = int(req.get("n_variations", 1))
+    temperature = float(req.get("temperature", 0.9))
+    min_chars = target_chars(int(req.get("duration_sec", 30)))
+
+    initial_resp = await _acreate(
+        model,
+        build_prompt_parts(req),
+        min_chars * n_variations,
+        "draft",
         temperature=temperature,
         top_p=0.95,
         n=n_variations,
         max_tokens=4096,
     )
-    
-    # 2. 各バリエーションをチェック & ブラッシュアップ
-    for choice in initial_resp.choices:
-        text = choice.message.content.strip()
-        tokens = _count_tokens(text, _MODEL_NAME)
-        # 規定に満たない場合、文章量を増やすようにリファイン
-        if tokens < min_tokens:
-            refine_instructions = (
-                f"あなたは動画広告のプロコピーライターです。"
-                f"以下の台本を添削して、より再生回数が増えるような台本にしてください。"
-                f"また、{min_tokens}文字以上になるように、内容を増やしてください。"
-                f"出力は、添削後の台本のみを返してください。\n\n"
-                f"１分ごとに改行してください。\n\n"
-            )
-            refine_prompt = f"{refine_instructions}\n\n{text}"  # 元文 + 指示
-            refine_resp = _client.chat.completions.create(
-                model=_MODEL_NAME,
-                messages=[{"role": "user", "content": refine_prompt}],
-                temperature=temperature,
-                top_p=0.95,
-                max_tokens=4096,
-            )
-
-    return [choice.message.content.strip() for choice in refine_resp.choices]
+    drafts = [(choice.message.content or "").strip() for choice in initial_resp.choices]
+
+    output_tokens = initial_resp.usage.completion_tokens if initial_resp.usage else None
+    ratio = tokens_per_char("".join(drafts), output_tokens)
+
+    # 不足分の続き書きはバリエーションごとに同時に行う (gather は投入順で結果を返す)
+    return list(await asyncio.gather(*(_aextend(model, text, min_chars, temperature, ratio) for text in drafts)))
+
+
+async def _astream_chat(
+    model: str,
+    prompt_parts: tuple[str, str],
+    temperature: float,
+    phase: str,
+    n: int = 1,
+    max_tokens: int = 4096,
+    usage: Dict[str, int] | None = None,
+    expected_chars: int = 0,
+) -> AsyncIterator[tuple[int, str]]:
+    """_stream_chat の async 版"""
+
+    async def _open(span: Span) -> AsyncIterator[tuple[int, str]]:
+        stream = await _get_async_client().chat.completions.create(
+            model=model,
+            messages=_messages(prompt_parts),
+            temperature=temperature,
+            top_p=0.95,
+            n=n,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for chunk in stream:
+            if chunk.usage:
+                _set_usage(span, chunk.usage)
+                if usage is not None:
+                    usage["output_tokens"] = chunk.usage.completion_tokens
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    yield choice.index, choice.delta.content
+
+    with track("OpenAI", model, phase, n) as span:
+        async for item in get_limiter("OpenAI").astream(
+            lambda: _open(span), estimate_tokens("".join(prompt_parts), expected_chars), span=span
+        ):
+            span.first_token()
+            yield item
+
+
+async def astream_ad_openai(req: Dict[str, Any]) -> AsyncIterator[StreamEvent]:
+    """stream_ad_openai の async 版"""
+    model = req.get("model") or _MODEL_NAME
+    n_variations = int(req.get("n_variations", 1))
+    temperature = float(req.get("temperature", 0.9))
+    min_chars = target_chars(int(req.get("duration_sec", 30)))
+
+    parts: List[List[str]] = [[] for _ in range(n_variations)]
+    usage: Dict[str, int] = {}
+    async for index, delta in _astream_chat(
+        model,
+        build_prompt_parts(req),
+        temperature,
+        "draft",
+        n=n_variations,
+        usage=usage,
+        expected_chars=min_chars * n_variations,
+    ):
+        parts[index].append(delta)
+        yield StreamEvent(index, "delta", delta)
+
+    drafts = ["".join(chunks).strip() for chunks in parts]
+    ratio = tokens_per_char("".join(drafts), usage.get("output_tokens"))
+
+    async def _extend_one(index: int, text: str) -> AsyncIterator[StreamEvent]:
+        missing = missing_chars(text, min_chars)
+        if missing:
+            extension: List[str] = []
+            yield StreamEvent(index, "delta", "\n")
+            async for _, delta in _astream_chat(
+                model,
+                build_extend_prompt_parts(text, missing),
+                temperature,
+                "extend",
+                max_tokens=extension_max_tokens(missing, ratio),
+                expected_chars=missing,
+            ):
+                extension.append(delta)
+                yield StreamEvent(index, "delta", delta)
+            text = join_extension(text, "".join(extension))
+        yield StreamEvent(index, "done", text)
+
+    async for event in amerge_streams(
+        [lambda index=index, text=text: _extend_one(index, text) for index, text in enumerate(drafts)]
+    ):
+        yield event
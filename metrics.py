@@ -0,0 +1,243 @@
+import atexit
+import contextvars
+import json
+import math
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List
+
+# ────────────────────────────────────────────────────────────────────────────
+# LLM 呼び出しの計測 (レイテンシ / TTFT / トークン / コスト)
+#   - llm_*.py の各 API 呼び出しを track() で囲む
+#   - レート制御の待ち・公平キュー・再試行の待ち (queue_sec) と、プロバイダー側の時間
+#     (latency_sec / ttft_sec = 最後の試行の送信から) を分けて記録する。
+#     試行の開始は rate_limit が span.begin_attempt() で知らせる
+#   - 1 呼び出し = 1 レコードを追記専用の JSONL トレースへ書き出す
+#     (ファイルへの追記は専用スレッドが行い、呼び出し側・api_server のイベントループを塞がない)
+#   - 直近のレコードはメモリにも保持し、app.py のメトリクスパネルで集計する
+# ────────────────────────────────────────────────────────────────────────────
+
+# 空文字にするとファイル出力を無効化
+_TRACE_PATH = os.getenv("LLM_TRACE_PATH", os.path.join(".cache", "llm_trace.jsonl"))
+_MAX_RECORDS = 10_000
+
+# USD / 100 万トークン (入力, 出力, キャッシュ読み込み時の入力単価の倍率)。
+# 前方一致で引くため具体的なモデル名を先に書く
+_PRICING: List[tuple[str, float, float, float]] = [
+    ("gpt-4o-mini", 0.15, 0.60, 0.5),
+    ("gpt-4o", 2.50, 10.00, 0.5),
+    ("claude-3-5-haiku", 0.80, 4.00, 0.1),
+    ("claude-3-haiku", 0.25, 1.25, 0.1),
+    ("claude-3-5-sonnet", 3.00, 15.00, 0.1),
+    ("gemini-1.5-flash", 0.075, 0.30, 0.25),
+    ("gemini-1.5-pro", 1.25, 5.00, 0.25),
+]
+
+# どの Streamlit セッション (またはバッチ実行) の呼び出しかを記録するためのタグ
+session_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("session_id", default=None)
+
+_records: Deque[Dict[str, Any]] = deque(maxlen=_MAX_RECORDS)
+_lock = threading.Lock()
+_listeners: List[Callable[[Dict[str, Any]], None]] = []
+
+# トレースファイルへの書き出し待ち (None は書き出しスレッドの終了通知)
+_trace_queue: "queue.SimpleQueue[Dict[str, Any] | None]" = queue.SimpleQueue()
+_trace_writer: threading.Thread | None = None
+
+
+def estimate_cost(
+    model: str, input_tokens: int | None, output_tokens: int | None, cached_tokens: int | None = None
+) -> float | None:
+    """料金表からコスト (USD) を計算。cached_tokens は input_tokens の内数。未知のモデルは None"""
+    for prefix, input_price, output_price, cached_ratio in _PRICING:
+        if model.startswith(prefix):
+            cached = cached_tokens or 0
+            uncached = max(0, (input_tokens or 0) - cached)
+            input_cost = uncached * input_price + cached * input_price * cached_ratio
+            return (input_cost + (output_tokens or 0) * output_price) / 1_000_000
+    return None
+
+
+class Span:
+    """1 回の API 呼び出しの計測値。track() の中で usage / 最初のトークン到着を書き込む"""
+
+    def __init__(self, provider: str, model: str, phase: str, variations: int = 1):
+        self.provider = provider
+        self.model = model
+        self.phase = phase
+        self.variations = variations  # 1 回の呼び出しで生成する本数 (OpenAI の n=)
+        self.started = time.perf_counter()
+        # 最後の試行をプロバイダーへ送った時刻 (rate_limit の待ち・枠の確保が済んだ後)
+        self.attempt_started: float | None = None
+        self.retry_status: List[int | None] = []  # 再試行した失敗の HTTP ステータス (429 など)
+        self.ttft_sec: float | None = None
+        self.input_tokens: int | None = None
+        self.output_tokens: int | None = None
+        self.cached_tokens: int | None = None  # input_tokens のうちプロンプトキャッシュから読まれた分
+
+    def begin_attempt(self) -> None:
+        """プロバイダーへ送る直前に呼ぶ (再試行のたびに呼び直し、計測を最後の試行に合わせる)"""
+        self.attempt_started = time.perf_counter()
+        self.ttft_sec = None
+
+    def retry(self, status: int | None) -> None:
+        """失敗した試行を再試行することになったときに呼ぶ"""
+        self.retry_status.append(status)
+
+    def first_token(self) -> None:
+        """ストリーミングで最初の差分が届いた時刻を記録 (2 回目以降は無視)"""
+        if self.ttft_sec is None:
+            self.ttft_sec = time.perf_counter() - (self.attempt_started or self.started)
+
+    def set_usage(
+        self, input_tokens: int | None, output_tokens: int | None, cached_tokens: int | None = None
+    ) -> None:
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cached_tokens = cached_tokens
+
+
+def add_listener(fn: Callable[[Dict[str, Any]], None]) -> None:
+    """レコードが書き出されるたびに呼ばれる関数を登録 (router の統計更新など)"""
+    with _lock:
+        if fn not in _listeners:
+            _listeners.append(fn)
+
+
+def _drain_trace() -> None:
+    """キューに届いたレコードをトレースファイルへ追記し続ける (書き出しスレッド本体)"""
+    if os.path.dirname(_TRACE_PATH):
+        os.makedirs(os.path.dirname(_TRACE_PATH), exist_ok=True)
+    with open(_TRACE_PATH, "a", encoding="utf-8") as f:
+        while True:
+            record = _trace_queue.get()
+            # 溜まっている分はまとめて書いてから flush する
+            while record is not None:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                try:
+                    record = _trace_queue.get_nowait()
+                except queue.Empty:
+                    break
+            f.flush()
+            if record is None:
+                return
+
+
+def _stop_trace_writer() -> None:
+    """終了時に書き出し待ちのレコードを書き切る"""
+    if _trace_writer is not None:
+        _trace_queue.put(None)
+        _trace_writer.join(timeout=5.0)
+
+
+def _write(record: Dict[str, Any]) -> None:
+    global _trace_writer
+    with _lock:
+        _records.append(record)
+        listeners = list(_listeners)
+        if _TRACE_PATH:
+            if _trace_writer is None:
+                _trace_writer = threading.Thread(target=_drain_trace, name="llm-trace", daemon=True)
+                _trace_writer.start()
+                atexit.register(_stop_trace_writer)
+            _trace_queue.put(record)
+    for fn in listeners:
+        fn(record)
+
+
+@contextmanager
+def track(provider: str, model: str, phase: str, variations: int = 1) -> Iterator[Span]:
+    """API 呼び出しを囲んで計測する。phase は "draft" (下書き) / "extend" (続き書き)"""
+    span = Span(provider, model, phase, variations)
+    error: str | None = None
+    try:
+        yield span
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        ended = time.perf_counter()
+        sent = span.attempt_started or span.started
+        _write(
+            {
+                "ts": time.time(),
+                "session_id": session_id.get(),
+                "provider": provider,
+                "model": model,
+                "phase": phase,
+                "variations": variations,
+                # プロバイダー側の時間 (最後の試行)。ローカルの待ちは queue_sec に分ける
+                "latency_sec": round(ended - sent, 4),
+                "queue_sec": round(sent - span.started, 4),
+                "retries": len(span.retry_status),
+                "retry_status": list(span.retry_status),
+                "ttft_sec": round(span.ttft_sec, 4) if span.ttft_sec is not None else None,
+                "input_tokens": span.input_tokens,
+                "output_tokens": span.output_tokens,
+                "cached_tokens": span.cached_tokens,
+                "cost_usd": estimate_cost(model, span.input_tokens, span.output_tokens, span.cached_tokens),
+                "ok": error is None,
+                "error": error,
+            }
+        )
+
+
+def recent_records(session: str | None = None) -> List[Dict[str, Any]]:
+    """メモリ上の直近レコード。session を指定するとそのセッション分のみ"""
+    with _lock:
+        records = list(_records)
+    if session is None:
+        return records
+    return [r for r in records if r["session_id"] == session]
+
+
+def percentile(values: List[float], q: float) -> float | None:
+    """最近傍順位法によるパーセンタイル"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """プロバイダーごとに p50/p95 レイテンシ・TTFT・待ち時間・再試行・続き書き率・トークン・キャッシュ率・コストを集計"""
+    by_provider: Dict[str, List[Dict[str, Any]]] = {}
+    for r in records:
+        by_provider.setdefault(r["provider"], []).append(r)
+
+    rows: List[Dict[str, Any]] = []
+    for provider, items in by_provider.items():
+        drafts = [r for r in items if r["phase"] == "draft"]
+        extends = [r for r in items if r["phase"] == "extend"]
+        n_drafts = sum(r["variations"] for r in drafts)
+        latencies = [r["latency_sec"] for r in drafts if r["ok"]]
+        queued = [r["queue_sec"] for r in items]
+        ttfts = [r["ttft_sec"] for r in items if r["ttft_sec"] is not None]
+        input_tokens = sum(r["input_tokens"] or 0 for r in items)
+        cached_tokens = sum(r.get("cached_tokens") or 0 for r in items)
+        rows.append(
+            {
+                "provider": provider,
+                "calls": len(items),
+                "errors": sum(1 for r in items if not r["ok"]),
+                "draft_p50_sec": percentile(latencies, 50),
+                "draft_p95_sec": percentile(latencies, 95),
+                "ttft_p50_sec": percentile(ttfts, 50),
+                # ローカルの待ち (レート制御・同時実行枠・再試行のバックオフ)
+                "queue_p95_sec": percentile(queued, 95),
+                "retries": sum(r["retries"] for r in items),
+                # 下書き 1 本あたり続き書きが発生した割合
+                "extend_rate": round(len(extends) / n_drafts, 3) if n_drafts else None,
+                "input_tokens": input_tokens,
+                "output_tokens": sum(r["output_tokens"] or 0 for r in items),
+                # 入力トークンのうちプロバイダー側のプロンプトキャッシュから読まれた割合
+                "cache_hit_rate": round(cached_tokens / input_tokens, 3) if input_tokens else None,
+                "cost_usd": round(sum(r["cost_usd"] or 0.0 for r in items), 6),
+            }
+        )
+    return rows
@@ -1,14 +1,30 @@
 # app/prompt_utils.py
-BASE_PROMPT = """
+# テンプレート (PREFIX_PROMPT / SUFFIX_PROMPT / _RULE / _EX / 続き書き指示) を変更したら上げる。
+# 生成結果キャッシュのキーに含まれるため、古いテンプレートの結果は再利用されない。
+PROMPT_VERSION = 3
+
+# ─────────────────────────────────────────────────────────────
+# プロンプトは「固定の前半 (prefix)」と「リクエストごとの後半 (suffix)」に分ける。
+#   prefix: 役割・書式ルール・出力例のみ。書式 (_RULE のキー) が同じなら
+#           バイト単位で同一になるため、プロバイダー側のプロンプトキャッシュが効く
+#           (Claude: cache_control / OpenAI・Gemini: 先頭一致の自動キャッシュ)
+#   suffix: 商品情報・本数・文字数など毎回変わる部分
+# prefix に可変値を入れるとキャッシュが効かなくなるので注意。
+# ─────────────────────────────────────────────────────────────
+PREFIX_PROMPT = """
 あなたは動画広告のプロコピーライターです。
-以下の条件で、{n_variations} 本の台本を日本語で生成してください。
-{char_count}文字程度となるように、構成を考えてください。
+ユーザーが指定する条件と背景情報に従って、動画広告の台本を日本語で生成してください。
 
 【必ず守る書式】
 {format_rule}
 
 【出力例】
 {example}
+"""
+
+SUFFIX_PROMPT = """
+以下の条件で、{n_variations} 本の台本を生成してください。
+{char_count}文字程度となるように、構成を考えてください。
 
 【背景情報】
 商品名: {product_name}
@@ -22,6 +38,15 @@ BASE_PROMPT = """
 台本を開始してください。
 """
 
+# 続き書き用の固定指示 (prefix)。不足文字数と台本本文は suffix 側に入れる
+EXTEND_PREFIX_PROMPT = (
+    "あなたは動画広告のプロコピーライターです。"
+    "ユーザーが渡す台本は目標の文字数に足りていません。"
+    "同じ書式・トーンのまま、この台本の続きとなる部分だけを書いてください。"
+    "既存の台本は繰り返さず、続きの本文のみを返してください。\n\n"
+    "１分ごとに改行してください。\n"
+)
+
 _RULE = {
     "serif_only":            "- 1 行に 1 セリフのみを書く。行頭にタイムコードも演出注釈も書かない。",
     "with_time":             "- 行頭に (0-5s) のような秒数レンジを付け、その後にセリフを書く。",
@@ -33,25 +58,40 @@ _EX = {
     "with_time_and_dir":     "(0-5s) こんにちは！ *(アップで手を振る)*",
 }
 
-def build_prompt(req: dict) -> str:
-    
-    with_timing = "serif_only"
-    with_direction = "serif_only"
-    
-    """req は views で組み立てた dict"""
+def build_prompt_parts(req: dict) -> tuple[str, str]:
+    """req は views で組み立てた dict。(キャッシュ可能な prefix, 可変の suffix) を返す"""
     key = ("with_time_and_dir" if req["with_timing"] and req["with_direction"]
            else "with_time"    if req["with_timing"]
            else "serif_only")
     # format() に渡す前に重複キーを削除
     safe_req = {k: v for k, v in req.items() if k not in {"n_variations"}}
 
-    return BASE_PROMPT.format(
-        n_variations=req["n_variations"],
+    prefix = PREFIX_PROMPT.format(
         format_rule=_RULE[key],
         example=_EX[key],
+    )
+    suffix = SUFFIX_PROMPT.format(
+        n_variations=req["n_variations"],
         char_count=calc_char_count(req["duration_sec"]),
         **safe_req           # ← 重複のない dict
     )
+    return prefix, suffix
+
+def build_prompt(req: dict) -> str:
+    """1 メッセージで送る場合のプロンプト (prefix + suffix)"""
+    return "".join(build_prompt_parts(req))
+
+def build_extend_prompt_parts(text: str, missing_chars: int) -> tuple[str, str]:
+    """文字数不足の台本に、不足分の「続き」だけを書かせるプロンプト (prefix, suffix)
+
+    台本全体を書き直させると出力トークンが倍増するため、追記部分のみを生成させる。
+    """
+    suffix = (
+        f"以下の台本は目標の文字数に約{missing_chars}文字足りません。"
+        f"続きを約{missing_chars}文字で書いてください。\n\n"
+        f"{text}"
+    )
+    return EXTEND_PREFIX_PROMPT, suffix
 
 def calc_char_count(duration_sec: int) -> int:
     """動画尺からおおよその文字数を計算"""
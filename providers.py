@@ -0,0 +1,82 @@
+import importlib
+import os
+import threading
+from types import ModuleType
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, NamedTuple
+
+from streaming import StreamEvent
+
+# ────────────────────────────────────────────────────────────────────────────
+# プロバイダーレジストリ
+#   - llm_*.py (と各 SDK) は初回利用時にはじめて import する
+#     (イベントループ上からは asyncio.to_thread で呼び、import 中にループを止めない)
+#   - API キーが設定されているプロバイダーだけを UI に出す
+#   - クライアントは各モジュールの _get_client() / _get_model() が
+#     プロセス全体で 1 つだけ生成・共有する
+# ────────────────────────────────────────────────────────────────────────────
+
+
+class ProviderSpec(NamedTuple):
+    """プロバイダー 1 社分の定義"""
+
+    name: str      # 表示名 (エラーメッセージ・キャッシュキーにも使う)
+    label: str     # タブ表示名
+    key: str       # llm_{key}.py / generate_ad_{key} / stream_ad_{key} / agenerate_ad_{key} / astream_ad_{key}
+    env_var: str   # API キーの環境変数名
+    color: str     # タブのブランドカラー
+
+
+PROVIDERS: List[ProviderSpec] = [
+    ProviderSpec("OpenAI", "OpenAI GPT-4o", "openai", "OPENAI_API_KEY", "#00a67e"),
+    ProviderSpec("Claude", "Claude 3 Haiku", "claude", "ANTHROPIC_API_KEY", "#6f4cff"),
+    ProviderSpec("Gemini", "Gemini 1.5", "gemini", "GOOGLE_GEMINI_API_KEY", "#4285F4"),
+]
+
+_BY_NAME: Dict[str, ProviderSpec] = {spec.name: spec for spec in PROVIDERS}
+_import_lock = threading.Lock()
+
+
+def get_spec(name: str) -> ProviderSpec:
+    return _BY_NAME[name]
+
+
+def is_configured(spec: ProviderSpec) -> bool:
+    """API キーが環境変数に設定されているか"""
+    return bool(os.getenv(spec.env_var))
+
+
+def configured_providers() -> List[ProviderSpec]:
+    """API キーが設定済みのプロバイダーのみ (表示順は PROVIDERS 順)"""
+    return [spec for spec in PROVIDERS if is_configured(spec)]
+
+
+def load_module(name: str) -> ModuleType:
+    """llm_{key}.py を初回利用時に import (2 回目以降は sys.modules のキャッシュ)"""
+    spec = get_spec(name)
+    with _import_lock:
+        return importlib.import_module(f"llm_{spec.key}")
+
+
+def get_generator(name: str) -> Callable[[Dict[str, Any]], List[str]]:
+    """generate_ad_{key} を返す"""
+    return getattr(load_module(name), f"generate_ad_{get_spec(name).key}")
+
+
+def get_streamer(name: str) -> Callable[[Dict[str, Any]], Iterator[StreamEvent]]:
+    """stream_ad_{key} を返す"""
+    return getattr(load_module(name), f"stream_ad_{get_spec(name).key}")
+
+
+def get_async_generator(name: str) -> Callable[[Dict[str, Any]], Awaitable[List[str]]]:
+    """agenerate_ad_{key} (async 版) を返す"""
+    return getattr(load_module(name), f"agenerate_ad_{get_spec(name).key}")
+
+
+def get_async_streamer(name: str) -> Callable[[Dict[str, Any]], AsyncIterator[StreamEvent]]:
+    """astream_ad_{key} (async 版) を返す"""
+    return getattr(load_module(name), f"astream_ad_{get_spec(name).key}")
+
+
+def get_model_name(name: str) -> str:
+    """そのプロバイダーで使うモデル名 (キャッシュキー用)"""
+    return load_module(name)._MODEL_NAME
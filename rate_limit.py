@@ -0,0 +1,447 @@
+import asyncio
+import email.utils
+import itertools
+import math
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, Tuple, TypeVar
+
+import metrics
+from metrics import Span
+
+# ────────────────────────────────────────────────────────────────────────────
+# プロバイダー別のレート制御 + リトライ
+#   - トークンバケットで RPM (リクエスト/分) と TPM (トークン/分) を制限
+#   - 429 / 5xx / 接続エラーは指数バックオフ + ジッターで再試行 (Retry-After を優先)
+#   - 同時実行数は AIMD で適応: 429 で半減、成功が続くと 1 ずつ回復
+#   - さらに全プロバイダー合計の同時実行数にも上限を設ける (全 Streamlit セッション共通)
+#   - 空いた枠は「実行中の呼び出しが最も少ないセッション」へ先に渡し、
+#     1 人の大量リクエストが他のユーザーを待たせ続けないようにする
+#   SDK 側の自動リトライは無効化し (max_retries=0)、ここで一元管理する
+#   span (metrics.Span) を渡すと、試行の開始 (待ち・枠の確保の後) と再試行を記録する
+#   async 版 (acall / astream) も同じバケット・同じ枠を共有し、待ちは asyncio.sleep で行う
+# ────────────────────────────────────────────────────────────────────────────
+
+T = TypeVar("T")
+
+_RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+_THROTTLE_STATUS = {429, 529}  # 529 = Anthropic overloaded
+
+_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+_BACKOFF_BASE_SEC = 1.0
+_BACKOFF_MAX_SEC = 60.0
+
+# プロバイダー別の既定値 (環境変数 {PREFIX}_RPM / _TPM / _MAX_INFLIGHT で上書き可)
+_DEFAULT_LIMITS: Dict[str, Dict[str, int]] = {
+    "OpenAI": {"rpm": 500, "tpm": 200_000, "max_inflight": 16},
+    "Claude": {"rpm": 50, "tpm": 50_000, "max_inflight": 8},
+    "Gemini": {"rpm": 1000, "tpm": 4_000_000, "max_inflight": 8},
+}
+_ENV_PREFIX = {"OpenAI": "OPENAI", "Claude": "CLAUDE", "Gemini": "GEMINI"}
+
+# 全プロバイダー合計の同時実行数、1 セッションあたりの上限 (0 = 上限なし)
+_GLOBAL_MAX_INFLIGHT = int(os.getenv("LLM_GLOBAL_MAX_INFLIGHT", "32"))
+_SESSION_MAX_INFLIGHT = int(os.getenv("LLM_SESSION_MAX_INFLIGHT", "0"))
+
+# 日本語の 1 文字あたりトークン数の目安 (TPM の見積もり用)
+_TOKENS_PER_CHAR = 1.2
+
+
+def estimate_tokens(prompt: str, expected_output_chars: int) -> int:
+    """TPM バケットから差し引く見積もりトークン数 (入力 + 想定出力)"""
+    return math.ceil((len(prompt) + expected_output_chars) * _TOKENS_PER_CHAR)
+
+
+class TokenBucket:
+    """1 分あたり rate_per_min 個を補充するトークンバケット"""
+
+    def __init__(self, rate_per_min: float, capacity: float | None = None):
+        self.rate_per_sec = rate_per_min / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_min
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_sec)
+        self._updated = now
+
+    def _take(self, amount: float) -> float:
+        """amount 個取れたら 0、足りなければ溜まるまでの秒数を返す"""
+        amount = min(amount, self.capacity)  # 容量より大きい要求は容量分で打ち切る
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate_per_sec
+
+    def acquire(self, amount: float = 1.0) -> None:
+        """amount 個取れるまで待つ"""
+        while wait := self._take(amount):
+            time.sleep(min(wait, 1.0))
+
+    async def aacquire(self, amount: float = 1.0) -> None:
+        """acquire の async 版 (イベントループを塞がない)"""
+        while wait := self._take(amount):
+            await asyncio.sleep(min(wait, 1.0))
+
+    def drain(self) -> None:
+        """サーバー側で制限された時点で、手元の残量も空にして送信を控える"""
+        with self._lock:
+            self._refill()
+            self._tokens = 0.0
+
+
+class FairScheduler:
+    """同時実行枠をセッション間で公平に配るセマフォ
+
+    枠が空くと、待っている呼び出しのうち「そのセッションの実行中数が最も少ない」ものを
+    (同数なら先に待ち始めたものを) 通す。セッションは metrics.session_id で区別する。
+    """
+
+    def __init__(self, limit: int, per_session: int = 0):
+        self.limit = limit
+        self.per_session = per_session
+        self._inflight: Dict[str, int] = {}
+        self._total = 0
+        self._waiting: Dict[int, str] = {}  # 待ち順の番号 → セッション
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+        # async 側の待ち手 (待ち番号 → (イベントループ, 起こすためのイベント))
+        self._async_waiters: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = {}
+
+    @property
+    def inflight(self) -> int:
+        return self._total
+
+    def _wake(self) -> None:
+        """待ち手を起こす (self._cond を保持した状態で呼ぶ)
+
+        スレッド側は全員、async 側は次に順番が来る 1 件だけを起こす (数百件の待ちでも空振りしない)。
+        """
+        self._cond.notify_all()
+        waiter = self._async_waiters.get(self._next()) if self._total < self.limit else None
+        if waiter is not None:
+            loop, event = waiter
+            loop.call_soon_threadsafe(event.set)
+
+    def set_limit(self, limit: int) -> None:
+        with self._cond:
+            self.limit = limit
+            self._wake()
+
+    def _next(self) -> int | None:
+        """次に通す待ち番号"""
+        candidates = [
+            (self._inflight.get(session, 0), ticket)
+            for ticket, session in self._waiting.items()
+            if not self.per_session or self._inflight.get(session, 0) < self.per_session
+        ]
+        return min(candidates)[1] if candidates else None
+
+    def _try_enter(self, ticket: int, session: str) -> bool:
+        """ticket の順番が来ていれば枠を確保する (self._cond を保持した状態で呼ぶ)"""
+        if self._total >= self.limit or self._next() != ticket:
+            return False
+        del self._waiting[ticket]
+        self._total += 1
+        self._inflight[session] = self._inflight.get(session, 0) + 1
+        # 枠がまだ残っていれば次の待ち手も起こす
+        self._wake()
+        return True
+
+    def _leave(self, session: str) -> None:
+        with self._cond:
+            self._total -= 1
+            self._inflight[session] -= 1
+            if not self._inflight[session]:
+                del self._inflight[session]
+            self._wake()
+
+    @contextmanager
+    def slot(self, session: str | None = None) -> Iterator[None]:
+        session = session or metrics.session_id.get() or "-"
+        ticket = next(self._tickets)
+        with self._cond:
+            self._waiting[ticket] = session
+            try:
+                while not self._try_enter(ticket, session):
+                    self._cond.wait()
+            except BaseException:
+                self._waiting.pop(ticket, None)
+                raise
+        try:
+            yield
+        finally:
+            self._leave(session)
+
+    @asynccontextmanager
+    async def aslot(self, session: str | None = None) -> AsyncIterator[None]:
+        """slot の async 版。スレッド側と同じ待ち行列に並び、枠が動くたびに起こされる"""
+        session = session or metrics.session_id.get() or "-"
+        ticket = next(self._tickets)
+        event = asyncio.Event()
+        with self._cond:
+            self._waiting[ticket] = session
+            self._async_waiters[ticket] = (asyncio.get_running_loop(), event)
+        try:
+            while True:
+                with self._cond:
+                    if self._try_enter(ticket, session):
+                        break
+                    # clear はロック内で行うため、この後の _wake() は取りこぼさない
+                    event.clear()
+                await event.wait()
+        except BaseException:
+            with self._cond:
+                self._waiting.pop(ticket, None)
+                self._wake()
+            raise
+        finally:
+            with self._cond:
+                self._async_waiters.pop(ticket, None)
+        try:
+            yield
+        finally:
+            self._leave(session)
+
+
+# 全プロバイダー・全セッション共通の同時実行枠
+_global_scheduler = FairScheduler(_GLOBAL_MAX_INFLIGHT, per_session=_SESSION_MAX_INFLIGHT)
+
+
+def get_global_scheduler() -> FairScheduler:
+    return _global_scheduler
+
+
+def _status_code(error: BaseException) -> int | None:
+    """SDK ごとに異なる例外から HTTP ステータスを取り出す"""
+    # openai / anthropic: status_code、google.api_core: code
+    for attr in ("status_code", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def _is_connection_error(error: BaseException) -> bool:
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return type(error).__name__ in {"APIConnectionError", "APITimeoutError", "DeadlineExceeded"}
+
+
+def _retry_after(error: BaseException) -> float | None:
+    """Retry-After / retry-after-ms ヘッダー (秒数 or HTTP 日付) を秒に変換"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+            return max(0.0, retry_at - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _begin_attempt(span: Span | None) -> None:
+    if span is not None:
+        span.begin_attempt()
+
+
+def _note_retry(span: Span | None, error: BaseException) -> None:
+    if span is not None:
+        span.retry(_status_code(error))
+
+
+class AdaptiveLimiter:
+    """1 プロバイダー分のレート制御・同時実行数制御・リトライ"""
+
+    def __init__(self, name: str, rpm: int, tpm: int, max_inflight: int, max_retries: int = _MAX_RETRIES):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+
+        self._limit = float(max_inflight)  # AIMD で増減する現在の同時実行上限
+        self._lock = threading.Lock()
+        self._slots = FairScheduler(max_inflight)
+
+    @property
+    def concurrency_limit(self) -> int:
+        return max(1, int(self._limit))
+
+    # ── 同時実行数 (AIMD) ───────────────────────────────────────────────────
+    @contextmanager
+    def _slot(self) -> Iterator[None]:
+        """プロバイダーの枠 → 全体の枠の順に確保する (どちらもセッション間で公平)"""
+        with self._slots.slot(), _global_scheduler.slot():
+            yield
+
+    @asynccontextmanager
+    async def _aslot(self) -> AsyncIterator[None]:
+        async with self._slots.aslot(), _global_scheduler.aslot():
+            yield
+
+    def _on_success(self) -> None:
+        with self._lock:
+            # 加算的に回復: 上限 N のとき N 回成功でおよそ +1
+            self._limit = min(float(self.max_inflight), self._limit + 1.0 / self._limit)
+            self._slots.set_limit(self.concurrency_limit)
+
+    def _on_throttle(self) -> None:
+        with self._lock:
+            self._limit = max(1.0, self._limit / 2.0)  # 乗算的に縮小
+            self._slots.set_limit(self.concurrency_limit)
+        self.requests.drain()
+
+    # ── リトライ判定 ────────────────────────────────────────────────────────
+    def _backoff(self, error: BaseException, attempt: int) -> float | None:
+        """再試行までの待ち秒数。再試行しない場合は None"""
+        status = _status_code(error)
+        if status not in _RETRYABLE_STATUS and not _is_connection_error(error):
+            return None
+        if attempt >= self.max_retries:
+            return None
+        if status in _THROTTLE_STATUS:
+            self._on_throttle()
+
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, _BACKOFF_MAX_SEC)
+        # full jitter
+        return random.uniform(0, min(_BACKOFF_MAX_SEC, _BACKOFF_BASE_SEC * 2 ** attempt))
+
+    def _admit(self, est_tokens: int) -> None:
+        self.requests.acquire(1)
+        self.tokens.acquire(est_tokens)
+
+    async def _aadmit(self, est_tokens: int) -> None:
+        await self.requests.aacquire(1)
+        await self.tokens.aacquire(est_tokens)
+
+    # ── Public API ──────────────────────────────────────────────────────────
+    def call(self, fn: Callable[[], T], est_tokens: int = 0, span: Span | None = None) -> T:
+        """fn() をレート制御・リトライ付きで実行"""
+        attempt = 0
+        while True:
+            self._admit(est_tokens)
+            try:
+                with self._slot():
+                    _begin_attempt(span)
+                    result = fn()
+            except Exception as e:
+                wait = self._backoff(e, attempt)
+                if wait is None:
+                    raise
+                _note_retry(span, e)
+                attempt += 1
+                time.sleep(wait)
+                continue
+            self._on_success()
+            return result
+
+    async def acall(self, fn: Callable[[], Awaitable[T]], est_tokens: int = 0, span: Span | None = None) -> T:
+        """call の async 版。fn は呼ぶたびに新しいコルーチンを返す関数"""
+        attempt = 0
+        while True:
+            await self._aadmit(est_tokens)
+            try:
+                async with self._aslot():
+                    _begin_attempt(span)
+                    result = await fn()
+            except Exception as e:
+                wait = self._backoff(e, attempt)
+                if wait is None:
+                    raise
+                _note_retry(span, e)
+                attempt += 1
+                await asyncio.sleep(wait)
+                continue
+            self._on_success()
+            return result
+
+    def stream(
+        self, open_stream: Callable[[], Iterator[T]], est_tokens: int = 0, span: Span | None = None
+    ) -> Iterator[T]:
+        """ストリーミング版。最初の要素が届く前の失敗のみ再試行し、受信中は同時実行枠を保持する"""
+        attempt = 0
+        while True:
+            self._admit(est_tokens)
+            with self._slot():
+                _begin_attempt(span)
+                started = False
+                try:
+                    for item in open_stream():
+                        started = True
+                        yield item
+                except Exception as e:
+                    wait = None if started else self._backoff(e, attempt)
+                    if wait is None:
+                        raise
+                    _note_retry(span, e)
+                else:
+                    self._on_success()
+                    return
+            attempt += 1
+            time.sleep(wait)
+
+    async def astream(
+        self, open_stream: Callable[[], AsyncIterator[T]], est_tokens: int = 0, span: Span | None = None
+    ) -> AsyncIterator[T]:
+        """stream の async 版。open_stream は呼ぶたびに新しい async イテレータを返す関数"""
+        attempt = 0
+        while True:
+            await self._aadmit(est_tokens)
+            async with self._aslot():
+                _begin_attempt(span)
+                started = False
+                try:
+                    async for item in open_stream():
+                        started = True
+                        yield item
+                except Exception as e:
+                    wait = None if started else self._backoff(e, attempt)
+                    if wait is None:
+                        raise
+                    _note_retry(span, e)
+                else:
+                    self._on_success()
+                    return
+            attempt += 1
+            await asyncio.sleep(wait)
+
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str) -> AdaptiveLimiter:
+    """プロバイダー名 ("OpenAI" / "Claude" / "Gemini") ごとにプロセスで 1 つの limiter"""
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            defaults = _DEFAULT_LIMITS[provider]
+            prefix = _ENV_PREFIX[provider]
+            limiter = AdaptiveLimiter(
+                provider,
+                rpm=int(os.getenv(f"{prefix}_RPM", defaults["rpm"])),
+                tpm=int(os.getenv(f"{prefix}_TPM", defaults["tpm"])),
+                max_inflight=int(os.getenv(f"{prefix}_MAX_INFLIGHT", defaults["max_inflight"])),
+            )
+            _limiters[provider] = limiter
+        return limiter
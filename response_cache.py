@@ -0,0 +1,325 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List
+
+from prompt_utils import PROMPT_VERSION
+from streaming import StreamEvent
+
+# ────────────────────────────────────────────────────────────────────────────
+# 生成結果のディスクキャッシュ
+#   - キー: 正規化したリクエスト辞書 + プロバイダー + モデル + プロンプト版数
+#   - SQLite に保存し、LRU (件数上限) と TTL (有効期限) で削除
+#   - 同じキーの生成が実行中なら、セッションをまたいで 1 回の呼び出しにまとめる
+#   - async 版 (agenerate / astream) は SQLite の読み書きをスレッドで行い、イベントループを塞がない
+# ────────────────────────────────────────────────────────────────────────────
+
+_CACHE_PATH = os.getenv("AD_CACHE_PATH", os.path.join(".cache", "ad_scripts.sqlite3"))
+_MAX_ENTRIES = int(os.getenv("AD_CACHE_MAX_ENTRIES", "1000"))
+_TTL_SEC = int(os.getenv("AD_CACHE_TTL_SEC", str(7 * 24 * 3600)))  # 既定 7 日
+
+# キャッシュキーから除外するキー（出力に影響しないもの）
+_IGNORED_KEYS = {"bypass_cache"}
+
+
+def _normalize(value: Any) -> Any:
+    """前後の空白・float の誤差など、出力に影響しない揺れを吸収する"""
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, float):
+        return round(value, 3)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items() if k not in _IGNORED_KEYS}
+    return value
+
+
+def make_key(provider: str, model: str, req: Dict[str, Any]) -> str:
+    """リクエスト辞書からキャッシュキー (sha256) を作る"""
+    payload = {
+        "provider": provider,
+        "model": model,
+        "prompt_version": PROMPT_VERSION,
+        "req": _normalize(req),
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _is_error(script: str) -> bool:
+    return script.startswith("❌")
+
+
+class ResponseCache:
+    """SQLite バックエンドの LRU/TTL キャッシュ + 実行中リクエストの合流"""
+
+    def __init__(self, path: str = _CACHE_PATH, max_entries: int = _MAX_ENTRIES, ttl_sec: int = _TTL_SEC):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key         TEXT PRIMARY KEY,
+                provider    TEXT NOT NULL,
+                scripts     TEXT NOT NULL,
+                created_at  REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)")
+        self._conn.commit()
+
+        self._db_lock = threading.Lock()
+        self._inflight_lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+
+    # ── 低レベル操作 ────────────────────────────────────────────────────────
+    def get(self, key: str) -> List[str] | None:
+        now = time.time()
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT scripts, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_sec:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, provider: str, scripts: List[str]) -> None:
+        # エラー文字列を含む結果は保存しない
+        if not scripts or any(_is_error(s) for s in scripts):
+            return
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, provider, json.dumps(scripts, ensure_ascii=False), now, now),
+            )
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_sec,))
+            # LRU: 上限を超えた分を最終アクセスが古い順に削除
+            self._conn.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    # ── 実行中リクエストの合流 ──────────────────────────────────────────────
+    def _join_or_lead(self, key: str) -> tuple[Future, bool]:
+        """(future, leader かどうか) を返す。leader だけが実際にプロバイダーを呼ぶ"""
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._inflight[key] = future
+            return future, True
+
+    def _release(self, key: str) -> None:
+        with self._inflight_lock:
+            self._inflight.pop(key, None)
+
+    # ── Public API ──────────────────────────────────────────────────────────
+    def generate(
+        self,
+        provider: str,
+        model: str,
+        req: Dict[str, Any],
+        generate_fn: Callable[[Dict[str, Any]], List[str]],
+        bypass: bool = False,
+    ) -> List[str]:
+        """キャッシュ経由で generate_ad_* を呼ぶ。bypass=True なら読み込みをせず新しく生成"""
+        key = make_key(provider, model, req)
+        if bypass:
+            scripts = generate_fn(req)
+            self.put(key, provider, scripts)
+            return scripts
+
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        future, leader = self._join_or_lead(key)
+        if not leader:
+            return future.result()
+
+        try:
+            scripts = generate_fn(req)
+            self.put(key, provider, scripts)
+            future.set_result(scripts)
+            return scripts
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._release(key)
+
+    def stream(
+        self,
+        provider: str,
+        model: str,
+        req: Dict[str, Any],
+        stream_fn: Callable[[Dict[str, Any]], Iterator[StreamEvent]],
+        bypass: bool = False,
+    ) -> Iterator[StreamEvent]:
+        """キャッシュ経由で stream_ad_* を呼ぶ。ヒット時は完成済みの台本を done イベントで返す"""
+        key = make_key(provider, model, req)
+
+        if not bypass:
+            cached = self.get(key)
+            if cached is not None:
+                for index, script in enumerate(cached):
+                    yield StreamEvent(index, "done", script)
+                return
+
+            future, leader = self._join_or_lead(key)
+            if not leader:
+                try:
+                    scripts = future.result()
+                except Exception:
+                    # leader が失敗・中断した場合は自分で生成し直す
+                    yield from self.stream(provider, model, req, stream_fn, bypass=True)
+                    return
+                for index, script in enumerate(scripts):
+                    yield StreamEvent(index, "done", script)
+                return
+        else:
+            future, leader = None, False
+
+        finals: Dict[int, str] = {}
+        try:
+            for event in stream_fn(req):
+                if event.kind in ("done", "error") and event.index >= 0:
+                    finals[event.index] = event.text
+                yield event
+            scripts = [finals[i] for i in sorted(finals)]
+            self.put(key, provider, scripts)
+            if future is not None:
+                future.set_result(scripts)
+        finally:
+            if future is not None:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"{provider} の生成が中断されました"))
+                self._release(key)
+
+
+    # ── async 版 (api_server 用) ───────────────────────────────────────────
+    @staticmethod
+    def _interrupted(provider: str, error: BaseException) -> Exception:
+        """合流している側へ渡す例外 (取り消しはスレッド側でも捕まえられる形にする)"""
+        return error if isinstance(error, Exception) else RuntimeError(f"{provider} の生成が中断されました")
+
+    async def agenerate(
+        self,
+        provider: str,
+        model: str,
+        req: Dict[str, Any],
+        agenerate_fn: Callable[[Dict[str, Any]], Awaitable[List[str]]],
+        bypass: bool = False,
+    ) -> List[str]:
+        """generate の async 版。実行中の同一リクエストとは、スレッド側の呼び出しも含めて合流する"""
+        key = make_key(provider, model, req)
+        if bypass:
+            scripts = await agenerate_fn(req)
+            await asyncio.to_thread(self.put, key, provider, scripts)
+            return scripts
+
+        cached = await asyncio.to_thread(self.get, key)
+        if cached is not None:
+            return cached
+
+        future, leader = self._join_or_lead(key)
+        if not leader:
+            # shield: 待っている側が取り消されても、leader の future は取り消さない
+            return await asyncio.shield(asyncio.wrap_future(future))
+
+        try:
+            scripts = await agenerate_fn(req)
+            await asyncio.to_thread(self.put, key, provider, scripts)
+            future.set_result(scripts)
+            return scripts
+        except BaseException as e:
+            future.set_exception(self._interrupted(provider, e))
+            raise
+        finally:
+            self._release(key)
+
+    async def astream(
+        self,
+        provider: str,
+        model: str,
+        req: Dict[str, Any],
+        astream_fn: Callable[[Dict[str, Any]], AsyncIterator[StreamEvent]],
+        bypass: bool = False,
+    ) -> AsyncIterator[StreamEvent]:
+        """stream の async 版"""
+        key = make_key(provider, model, req)
+
+        if not bypass:
+            cached = await asyncio.to_thread(self.get, key)
+            if cached is not None:
+                for index, script in enumerate(cached):
+                    yield StreamEvent(index, "done", script)
+                return
+
+            future, leader = self._join_or_lead(key)
+            if not leader:
+                try:
+                    scripts = await asyncio.shield(asyncio.wrap_future(future))
+                except Exception:
+                    async for event in self.astream(provider, model, req, astream_fn, bypass=True):
+                        yield event
+                    return
+                for index, script in enumerate(scripts):
+                    yield StreamEvent(index, "done", script)
+                return
+        else:
+            future, leader = None, False
+
+        finals: Dict[int, str] = {}
+        try:
+            async for event in astream_fn(req):
+                if event.kind in ("done", "error") and event.index >= 0:
+                    finals[event.index] = event.text
+                yield event
+            scripts = [finals[i] for i in sorted(finals)]
+            await asyncio.to_thread(self.put, key, provider, scripts)
+            if future is not None:
+                future.set_result(scripts)
+        finally:
+            if future is not None:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"{provider} の生成が中断されました"))
+                self._release(key)
+
+
+_cache: ResponseCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> ResponseCache:
+    """プロセス全体で共有するキャッシュ (全 Streamlit セッション共通)"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
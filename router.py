@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+import metrics
+from length_utils import target_chars
+from prompt_utils import build_prompt
+from providers import get_model_name
+from rate_limit import estimate_tokens
+
+# ────────────────────────────────────────────────────────────────────────────
+# レイテンシ・コストを見てモデルを選ぶルーター
+#   - metrics のレコードから、プロバイダー × モデルごとに EWMA を更新する
+#     (出力 1 トークンあたりの秒数 / 続き書き 1 回の秒数 / エラー率 / 続き書き率 / コスト)
+#     秒数はプロバイダー側の時間 (latency_sec) で、rate_limit の待ち・再試行は含まない
+#   - リクエストごとに、レイテンシ予算・コスト上限を満たす候補のうち
+#     「1 秒あたり・1 ドルあたりの台本数」が最も多いモデルを選ぶ
+#   - エラー率がしきい値を超えたモデルは一定時間候補から外す (劣化時の自動フォールバック)
+# ────────────────────────────────────────────────────────────────────────────
+
+_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+# 直近のエラー率がこれ以上のモデルは劣化とみなす
+_DEGRADED_ERROR_RATE = float(os.getenv("ROUTER_DEGRADED_ERROR_RATE", "0.3"))
+_DEGRADED_COOLDOWN_SEC = float(os.getenv("ROUTER_COOLDOWN_SEC", "60"))
+_MIN_SAMPLES = 3
+
+# 候補モデル。各モジュールの既定モデルが常に先頭に来る。
+# 環境変数 {PREFIX}_MODELS="a,b,c" で上書き可
+_CANDIDATES: Dict[str, List[str]] = {
+    "OpenAI": ["gpt-4o-mini", "gpt-4o"],
+    "Claude": ["claude-3-5-haiku-latest", "claude-3-haiku-20240307", "claude-3-5-sonnet-latest"],
+    "Gemini": ["gemini-1.5-flash-latest", "gemini-1.5-pro-latest"],
+}
+_ENV_PREFIX = {"OpenAI": "OPENAI", "Claude": "CLAUDE", "Gemini": "GEMINI"}
+
+
+def _ewma(current: float | None, value: float) -> float:
+    return value if current is None else current + _ALPHA * (value - current)
+
+
+def candidates(provider: str) -> List[str]:
+    """provider の候補モデル (既定モデルが先頭)"""
+    env = os.getenv(f"{_ENV_PREFIX[provider]}_MODELS")
+    models = [m.strip() for m in env.split(",") if m.strip()] if env else list(_CANDIDATES[provider])
+    default = get_model_name(provider)
+    return [default] + [m for m in models if m != default]
+
+
+class ModelStats:
+    """1 プロバイダー × 1 モデル分の移動平均"""
+
+    def __init__(self) -> None:
+        self.samples = 0
+        self.sec_per_token: float | None = None  # 下書き 1 本の出力 1 トークンあたりの秒数
+        self.extend_sec: float | None = None  # 続き書き 1 回の秒数
+        self.draft_cost: float | None = None  # 下書き 1 本あたりの USD
+        self.extend_cost: float | None = None  # 続き書き 1 回あたりの USD
+        self.error_rate = 0.0
+        # 減衰付きの下書き本数・続き書き回数 (比が続き書き率)
+        self.drafts = 0.0
+        self.extends = 0.0
+        self.degraded_until = 0.0
+
+    @property
+    def refine_rate(self) -> float:
+        return min(1.0, self.extends / self.drafts) if self.drafts else 0.0
+
+    def observe(self, record: Dict[str, Any]) -> None:
+        self.samples += 1
+        self.error_rate = _ewma(self.error_rate if self.samples > 1 else None, 0.0 if record["ok"] else 1.0)
+        if self.samples >= _MIN_SAMPLES and self.error_rate >= _DEGRADED_ERROR_RATE:
+            self.degraded_until = time.time() + _DEGRADED_COOLDOWN_SEC
+        if not record["ok"]:
+            return
+
+        variations = max(1, record["variations"])
+        if record["phase"] == "draft":
+            self.drafts = self.drafts * (1 - _ALPHA) + variations
+            self.extends *= 1 - _ALPHA
+            # n= で複数本を 1 回に生成した場合も、レイテンシは 1 本分の長さで決まる
+            if record["output_tokens"]:
+                tokens_per_script = record["output_tokens"] / variations
+                self.sec_per_token = _ewma(self.sec_per_token, record["latency_sec"] / tokens_per_script)
+            if record["cost_usd"] is not None:
+                self.draft_cost = _ewma(self.draft_cost, record["cost_usd"] / variations)
+        else:
+            self.extends += 1
+            self.extend_sec = _ewma(self.extend_sec, record["latency_sec"])
+            if record["cost_usd"] is not None:
+                self.extend_cost = _ewma(self.extend_cost, record["cost_usd"])
+
+
+class Router:
+    """プロセス全体で共有する統計 + モデル選択"""
+
+    def __init__(self) -> None:
+        self._stats: Dict[Tuple[str, str], ModelStats] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, record: Dict[str, Any]) -> None:
+        """metrics のレコード 1 件を統計に反映 (metrics.add_listener で登録)"""
+        with self._lock:
+            self._stats.setdefault((record["provider"], record["model"]), ModelStats()).observe(record)
+
+    def _estimate(self, provider: str, model: str, req: Dict[str, Any]) -> Tuple[float | None, float | None]:
+        """(1 リクエスト分の予想秒数, 予想 USD)。観測が無い値は料金表から見積もるか None"""
+        n_variations = int(req.get("n_variations", 1))
+        output_tokens = estimate_tokens("", target_chars(int(req.get("duration_sec", 30))))
+        stats = self._stats.get((provider, model))
+
+        latency = None
+        if stats and stats.sec_per_token is not None:
+            latency = stats.sec_per_token * output_tokens + stats.refine_rate * (stats.extend_sec or 0.0)
+
+        if stats and stats.draft_cost is not None:
+            per_script = stats.draft_cost + stats.refine_rate * (stats.extend_cost or 0.0)
+        else:
+            per_script = metrics.estimate_cost(model, estimate_tokens(build_prompt(req), 0), output_tokens)
+        cost = per_script * n_variations if per_script is not None else None
+        return latency, cost
+
+    def choose(
+        self,
+        provider: str,
+        req: Dict[str, Any],
+        latency_budget_sec: float | None = None,
+        cost_ceiling_usd: float | None = None,
+    ) -> str:
+        """req に使うモデルを選ぶ
+
+        劣化中のモデルを除いた候補のうち、予算・上限を満たすものから
+        予想秒数 × 予想 USD が最小 (= 1 秒・1 ドルあたりの台本数が最大) のものを返す。
+        満たす候補が無ければ、予算があれば最速、なければ最安のものを返す。
+        """
+        models = candidates(provider)
+        now = time.time()
+        with self._lock:
+            healthy = [m for m in models if self._stats.get((provider, m), ModelStats()).degraded_until <= now]
+            if not healthy:
+                # 全候補が劣化中: エラー率が最も低いものへフォールバック
+                return min(models, key=lambda m: self._stats[(provider, m)].error_rate)
+            options = [(m, *self._estimate(provider, m, req)) for m in healthy]
+
+        # 未観測のモデルは観測済みの最速と同じとみなし、一度は試されるようにする
+        known = [latency for _, latency, _ in options if latency is not None]
+        default_latency = min(known) if known else 1.0
+        options = [(m, default_latency if latency is None else latency, cost) for m, latency, cost in options]
+
+        # 料金が分からないモデルはコスト上限を満たさないものとして扱う
+        feasible = [
+            (m, latency, cost)
+            for m, latency, cost in options
+            if (latency_budget_sec is None or latency <= latency_budget_sec)
+            and (cost_ceiling_usd is None or (cost is not None and cost <= cost_ceiling_usd))
+        ]
+        if not feasible:
+            if latency_budget_sec is not None:
+                return min(options, key=lambda o: o[1])[0]
+            return min(options, key=lambda o: float("inf") if o[2] is None else o[2])[0]
+        # min() は同点なら先の候補 (既定モデル) を返す
+        return min(feasible, key=lambda o: o[1] * (float("inf") if o[2] is None else o[2]))[0]
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """メトリクスパネル用の一覧"""
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "provider": provider,
+                    "model": model,
+                    "samples": stats.samples,
+                    "sec_per_token": round(stats.sec_per_token, 4) if stats.sec_per_token is not None else None,
+                    "error_rate": round(stats.error_rate, 3),
+                    "refine_rate": round(stats.refine_rate, 3),
+                    "cost_per_script_usd": round(stats.draft_cost, 6) if stats.draft_cost is not None else None,
+                    "degraded": stats.degraded_until > now,
+                }
+                for (provider, model), stats in sorted(self._stats.items())
+            ]
+
+
+_router: Router | None = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> Router:
+    """プロセス全体で共有するルーター。初回生成時にメモリ上の直近レコードで統計を温める"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = Router()
+            for record in metrics.recent_records():
+                _router.observe(record)
+            metrics.add_listener(_router.observe)
+        return _router
@@ -0,0 +1,20 @@
+from typing import NamedTuple
+
+# ────────────────────────────────────────────────────────────────────────────
+# ストリーミング生成用のイベント定義
+#   stream_ad_openai / stream_ad_claude / stream_ad_gemini が yield する型
+# ────────────────────────────────────────────────────────────────────────────
+
+
+class StreamEvent(NamedTuple):
+    """ストリーミング生成中の 1 イベント
+
+    kind:
+        - "delta": text はバリエーション index に追記する差分
+        - "done" : text はそのバリエーションの最終台本（長さチェック・続き書き後）
+        - "error": text はエラーメッセージ
+    """
+
+    index: int
+    kind: str
+    text: str
@@ -0,0 +1,430 @@
+"""OpenAI / Anthropic / Gemini の API を模したローカルスタブサーバー (ベンチマーク用)
+
+実際の API を呼ばずに生成パイプラインの性能を測るため、3 社のワイヤーフォーマット
+(通常レスポンスと SSE ストリーミング) を 1 つの HTTP サーバーで返す。
+レイテンシ分布・出力文字数・エラー率は StubConfig で指定する。
+
+    OpenAI   : POST {base}/v1/chat/completions           (OPENAI_BASE_URL={base}/v1)
+    Anthropic: POST {base}/v1/messages                    (ANTHROPIC_BASE_URL={base})
+    Gemini   : POST {base}/v1beta/models/{m}:generateContent / :streamGenerateContent
+                                                           (GEMINI_API_ENDPOINT={base})
+
+単体起動:
+    python stub_servers.py --port 8765 --ttft-median-sec 0.8 --output-chars 1800
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, NamedTuple
+from urllib.parse import parse_qs, urlparse
+
+
+class StubConfig(NamedTuple):
+    """スタブの振る舞い"""
+
+    ttft_median_sec: float = 0.5     # 最初のトークンまでの時間 (対数正規分布の中央値)
+    ttft_sigma: float = 0.3          # 対数正規分布の σ (0 で固定値)
+    chars_per_sec: float = 400.0     # 生成速度 (文字/秒)
+    output_chars: int = 2400         # 1 回の生成で返す文字数
+    output_jitter: float = 0.1       # 出力文字数の揺らぎ (±割合)
+    error_rate: float = 0.0          # エラーを返す確率
+    throttle_share: float = 0.7      # エラーのうち 429 (残りは 503) の割合
+    retry_after_sec: float = 0.2     # 429 に付ける Retry-After
+    chunk_chars: int = 20            # ストリーミング 1 チャンクあたりの文字数
+
+
+_LINES = [
+    "こんにちは！寝返りうててますか？",
+    "朝起きたら首がガチガチ、そんな毎日を送っていませんか。",
+    "実はその原因、枕の高さが合っていないからかもしれません。",
+    "この枕なら、頭と首をやさしく包み込んで理想の寝姿勢をキープ。",
+    "まるでホテルに泊まったような深い眠りを、毎晩ご自宅で。",
+    "今なら送料無料でお届けします。",
+]
+# 続き書き (extend) 用プロンプトの目印。prompt_utils.build_extend_prompt_parts と対応
+_EXTEND_MARKER = "続きとなる部分だけ"
+_MISSING_RE = re.compile(r"約(\d+)文字足りません")
+
+
+def _fake_script(n_chars: int) -> str:
+    """n_chars 文字程度のダミー台本 (1 行 1 セリフ)"""
+    lines: List[str] = []
+    total = 0
+    i = 0
+    while total < n_chars:
+        line = _LINES[i % len(_LINES)]
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return "\n".join(lines)
+
+
+def _chunks(text: str, size: int) -> Iterator[str]:
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+class StubState:
+    """リクエスト数などのカウンタ (ベンチマークの集計用)"""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.counts[key] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StubServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass  # アクセスログは出さない
+
+    # ── 共通処理 ────────────────────────────────────────────────────────────
+    @property
+    def config(self) -> StubConfig:
+        return self.server.state.config
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, status: int, body: Any, headers: Dict[str, str] | None = None) -> None:
+        raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _start_stream(self, content_type: str) -> None:
+        # Content-Length 無し + 接続クローズで本文の終わりを伝える
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def _write(self, data: str) -> None:
+        self.wfile.write(data.encode("utf-8"))
+        self.wfile.flush()
+
+    def _maybe_fail(self, provider: str) -> bool:
+        """error_rate に従ってエラーレスポンスを返す。返した場合 True"""
+        if random.random() >= self.config.error_rate:
+            return False
+        if random.random() < self.config.throttle_share:
+            self.server.state.count(f"{provider}:429")
+            self._send_json(
+                429,
+                {"error": {"type": "rate_limit_error", "message": "stub: rate limited", "code": 429}},
+                {"Retry-After": str(self.config.retry_after_sec)},
+            )
+        else:
+            self.server.state.count(f"{provider}:503")
+            self._send_json(503, {"error": {"type": "overloaded_error", "message": "stub: unavailable", "code": 503}})
+        return True
+
+    def _wait_first_token(self) -> None:
+        c = self.config
+        delay = c.ttft_median_sec * math.exp(c.ttft_sigma * random.gauss(0, 1)) if c.ttft_sigma else c.ttft_median_sec
+        time.sleep(delay)
+
+    def _output_text(self, prompt: str) -> str:
+        """続き書きなら不足分、通常は output_chars ± jitter 文字の台本"""
+        c = self.config
+        match = _MISSING_RE.search(prompt)
+        if _EXTEND_MARKER in prompt and match:
+            n_chars = int(match.group(1))
+        else:
+            n_chars = int(c.output_chars * (1 + random.uniform(-c.output_jitter, c.output_jitter)))
+        return _fake_script(max(1, n_chars))
+
+    def _generate(self, prompt: str) -> str:
+        """非ストリーミング: 全文生成にかかる時間だけ待ってから返す"""
+        self._wait_first_token()
+        text = self._output_text(prompt)
+        time.sleep(len(text) / self.config.chars_per_sec)
+        return text
+
+    def _stream(self, prompt: str) -> Iterator[str]:
+        """ストリーミング: 生成速度に合わせてチャンクを返す"""
+        self._wait_first_token()
+        text = self._output_text(prompt)
+        for i, piece in enumerate(_chunks(text, self.config.chunk_chars)):
+            if i:
+                time.sleep(len(piece) / self.config.chars_per_sec)
+            yield piece
+
+    def _count_call(self, provider: str, prompt: str) -> None:
+        self.server.state.count(f"{provider}:requests")
+        if _EXTEND_MARKER in prompt:
+            self.server.state.count(f"{provider}:extend")
+
+    # ── ルーティング ────────────────────────────────────────────────────────
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        body = self._read_json()
+        if url.path.endswith("/chat/completions"):
+            self._openai(body)
+        elif url.path.endswith("/messages"):
+            self._anthropic(body)
+        elif ":generateContent" in url.path or ":streamGenerateContent" in url.path:
+            self._gemini(url, body)
+        else:
+            self._send_json(404, {"error": {"message": f"stub: unknown path {url.path}"}})
+
+    # ── OpenAI ──────────────────────────────────────────────────────────────
+    def _openai(self, body: Dict[str, Any]) -> None:
+        prompt = "".join(str(m.get("content", "")) for m in body.get("messages", []))
+        self._count_call("OpenAI", prompt)
+        if self._maybe_fail("OpenAI"):
+            return
+
+        n = int(body.get("n") or 1)
+        model = body.get("model", "stub")
+        created = int(time.time())
+        resp_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        if not body.get("stream"):
+            # n 本は並列に生成される想定: 待ち時間は最長の 1 本分
+            self._wait_first_token()
+            texts = [self._output_text(prompt) for _ in range(n)]
+            time.sleep(max(len(t) for t in texts) / self.config.chars_per_sec)
+            completion_tokens = sum(len(t) for t in texts)
+            self._send_json(
+                200,
+                {
+                    "id": resp_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {"index": i, "message": {"role": "assistant", "content": t}, "finish_reason": "stop"}
+                        for i, t in enumerate(texts)
+                    ],
+                    "usage": {
+                        "prompt_tokens": len(prompt),
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": len(prompt) + completion_tokens,
+                    },
+                },
+            )
+            return
+
+        def chunk(choices: List[Dict[str, Any]], usage: Dict[str, int] | None = None) -> str:
+            payload = {
+                "id": resp_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+                "usage": usage,
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        self._start_stream("text/event-stream")
+        completion_tokens = 0
+        # n 本を順番に流す (実 API は混在するが、クライアントは index で振り分けるので同等)
+        for i in range(n):
+            for piece in self._stream(prompt):
+                completion_tokens += len(piece)
+                self._write(chunk([{"index": i, "delta": {"content": piece}, "finish_reason": None}]))
+            self._write(chunk([{"index": i, "delta": {}, "finish_reason": "stop"}]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._write(
+                chunk(
+                    [],
+                    {
+                        "prompt_tokens": len(prompt),
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": len(prompt) + completion_tokens,
+                    },
+                )
+            )
+        self._write("data: [DONE]\n\n")
+
+    # ── Anthropic ───────────────────────────────────────────────────────────
+    def _anthropic(self, body: Dict[str, Any]) -> None:
+        def _text(content: Any) -> str:
+            if isinstance(content, str):
+                return content
+            return "".join(block.get("text", "") for block in content or [])
+
+        prompt = _text(body.get("system")) + "".join(_text(m.get("content")) for m in body.get("messages", []))
+        self._count_call("Claude", prompt)
+        if self._maybe_fail("Claude"):
+            return
+
+        model = body.get("model", "stub")
+        msg_id = f"msg_{uuid.uuid4().hex}"
+
+        if not body.get("stream"):
+            text = self._generate(prompt)
+            self._send_json(
+                200,
+                {
+                    "id": msg_id,
+                    "type": "message",
+                    "role": "assistant",
+                    "model": model,
+                    "content": [{"type": "text", "text": text}],
+                    "stop_reason": "end_turn",
+                    "stop_sequence": None,
+                    "usage": {"input_tokens": len(prompt), "output_tokens": len(text)},
+                },
+            )
+            return
+
+        def event(name: str, data: Dict[str, Any]) -> str:
+            return f"event: {name}\ndata: {json.dumps({'type': name, **data}, ensure_ascii=False)}\n\n"
+
+        self._start_stream("text/event-stream")
+        self._write(
+            event(
+                "message_start",
+                {
+                    "message": {
+                        "id": msg_id,
+                        "type": "message",
+                        "role": "assistant",
+                        "model": model,
+                        "content": [],
+                        "stop_reason": None,
+                        "stop_sequence": None,
+                        "usage": {"input_tokens": len(prompt), "output_tokens": 0},
+                    }
+                },
+            )
+        )
+        self._write(event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}}))
+        output_tokens = 0
+        for piece in self._stream(prompt):
+            output_tokens += len(piece)
+            self._write(event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": piece}}))
+        self._write(event("content_block_stop", {"index": 0}))
+        self._write(
+            event(
+                "message_delta",
+                {"delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": output_tokens}},
+            )
+        )
+        self._write(event("message_stop", {}))
+
+    # ── Gemini ──────────────────────────────────────────────────────────────
+    def _gemini(self, url: Any, body: Dict[str, Any]) -> None:
+        prompt = "".join(
+            part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", [])
+        )
+        self._count_call("Gemini", prompt)
+        if self._maybe_fail("Gemini"):
+            return
+
+        def response(text: str, output_tokens: int) -> Dict[str, Any]:
+            return {
+                "candidates": [
+                    {"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}
+                ],
+                "usageMetadata": {
+                    "promptTokenCount": len(prompt),
+                    "candidatesTokenCount": output_tokens,
+                    "totalTokenCount": len(prompt) + output_tokens,
+                },
+            }
+
+        if ":streamGenerateContent" not in url.path:
+            text = self._generate(prompt)
+            self._send_json(200, response(text, len(text)))
+            return
+
+        # alt=sse なら SSE、それ以外 (REST トランスポート既定) は JSON 配列を少しずつ返す
+        sse = parse_qs(url.query).get("alt", [""])[0] == "sse"
+        self._start_stream("text/event-stream" if sse else "application/json")
+        output_tokens = 0
+        if not sse:
+            self._write("[")
+        for i, piece in enumerate(self._stream(prompt)):
+            output_tokens += len(piece)
+            payload = json.dumps(response(piece, output_tokens), ensure_ascii=False)
+            if sse:
+                self._write(f"data: {payload}\n\n")
+            else:
+                self._write(("," if i else "") + payload)
+        if not sse:
+            self._write("]")
+
+
+class StubServer(ThreadingHTTPServer):
+    """3 社分のエンドポイントをまとめて提供するスタブサーバー"""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, config: StubConfig = StubConfig()):
+        super().__init__((host, port), _Handler)
+        self.state = StubState(config)
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self) -> Dict[str, str]:
+        """SDK クライアントをこのサーバーへ向けるための環境変数"""
+        return {
+            "OPENAI_BASE_URL": f"{self.base_url}/v1",
+            "ANTHROPIC_BASE_URL": self.base_url,
+            "GEMINI_API_ENDPOINT": self.base_url,
+            "OPENAI_API_KEY": "stub-key",
+            "ANTHROPIC_API_KEY": "stub-key",
+            "GOOGLE_GEMINI_API_KEY": "stub-key",
+        }
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="LLM API スタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    for field, default in StubConfig._field_defaults.items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    config = StubConfig(**{field: getattr(args, field) for field in StubConfig._fields})
+    server = StubServer(args.host, args.port, config)
+    for key, value in server.env().items():
+        print(f"export {key}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
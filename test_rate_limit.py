@@ -0,0 +1,322 @@
+import asyncio
+import threading
+import time
+from typing import List
+
+import pytest
+
+from metrics import Span
+from rate_limit import AdaptiveLimiter, FairScheduler, TokenBucket
+
+# ────────────────────────────────────────────────────────────────────────────
+# rate_limit の同時実行制御 (FairScheduler / AIMD / TokenBucket) のテスト
+#   スレッド側 (slot) と async 側 (aslot) が同じ待ち行列を共有することも確認する
+# ────────────────────────────────────────────────────────────────────────────
+
+
+def _wait_until(predicate, timeout: float = 2.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+class _Holder:
+    """別スレッドで slot を確保し、release() まで保持する"""
+
+    def __init__(self, scheduler: FairScheduler, session: str, entered: List[str]):
+        self._release = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(scheduler, session, entered), daemon=True)
+        self._thread.start()
+
+    def _run(self, scheduler: FairScheduler, session: str, entered: List[str]) -> None:
+        with scheduler.slot(session):
+            entered.append(session)
+            self._release.wait()
+
+    def release(self) -> None:
+        self._release.set()
+        self._thread.join(timeout=2.0)
+
+
+def _hold(scheduler: FairScheduler, session: str, entered: List[str]) -> _Holder:
+    """待ち行列に並んだ (または枠を確保した) ところまで進めて返す"""
+    before = (len(scheduler._waiting), scheduler.inflight)
+    holder = _Holder(scheduler, session, entered)
+    _wait_until(lambda: (len(scheduler._waiting), scheduler.inflight) != before)
+    return holder
+
+
+# ── FairScheduler: 入場順 ───────────────────────────────────────────────────
+def test_freed_slot_goes_to_session_with_fewest_inflight():
+    scheduler = FairScheduler(limit=2)
+    entered: List[str] = []
+    heavy = [_hold(scheduler, "heavy", entered) for _ in range(2)]
+    # heavy が先に 2 件並び、light はその後に並ぶ
+    queued = [_hold(scheduler, "heavy", entered) for _ in range(2)] + [_hold(scheduler, "light", entered)]
+    assert entered == ["heavy", "heavy"]
+
+    heavy[0].release()
+    # 実行中 heavy=1 / light=0 なので、後から並んだ light が先に入る
+    _wait_until(lambda: len(entered) == 3)
+    assert entered[2] == "light"
+
+    heavy[1].release()
+    _wait_until(lambda: len(entered) == 4)
+    for holder in queued:
+        holder.release()
+    _wait_until(lambda: len(entered) == 5)
+    assert entered[3:] == ["heavy", "heavy"]
+    assert scheduler.inflight == 0
+
+
+def test_same_session_waiters_enter_in_arrival_order():
+    scheduler = FairScheduler(limit=1)
+    entered: List[str] = []
+    first = _hold(scheduler, "s", entered)
+    waiters = [_hold(scheduler, "s", entered) for _ in range(3)]
+    tickets = list(scheduler._waiting)
+    assert tickets == sorted(tickets)
+
+    first.release()
+    for i, holder in enumerate(waiters):
+        _wait_until(lambda: len(entered) == i + 2)
+        # 最も古い待ち番号から順に抜けていく
+        assert list(scheduler._waiting) == tickets[i + 1:]
+        holder.release()
+    assert scheduler.inflight == 0
+
+
+# ── FairScheduler: セッションあたりの上限 ────────────────────────────────────
+def test_per_session_cap_blocks_only_that_session():
+    async def scenario() -> None:
+        scheduler = FairScheduler(limit=4, per_session=1)
+        async with scheduler.aslot("a"):
+            # 全体の枠は空いていても、a の 2 件目は入れない
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(_enter(scheduler, "a"), 0.1)
+            # 別セッションはすぐ入れる
+            await asyncio.wait_for(_enter(scheduler, "b"), 0.5)
+        assert scheduler.inflight == 0
+        assert not scheduler._waiting
+
+    asyncio.run(scenario())
+
+
+async def _enter(scheduler: FairScheduler, session: str) -> None:
+    async with scheduler.aslot(session):
+        pass
+
+
+def test_capped_session_does_not_block_others_behind_it():
+    async def scenario() -> None:
+        scheduler = FairScheduler(limit=2, per_session=1)
+        order: List[str] = []
+        release = asyncio.Event()
+
+        async def worker(session: str) -> None:
+            async with scheduler.aslot(session):
+                order.append(session)
+                await release.wait()
+
+        first = asyncio.create_task(worker("a"))
+        await asyncio.sleep(0)
+        # 上限に達した a の 2 件目が先頭に並んでいても、空き枠は後ろの b に渡る
+        rest = [asyncio.create_task(worker("a")), asyncio.create_task(worker("b"))]
+        await asyncio.sleep(0.01)
+        assert order == ["a", "b"]
+        assert list(scheduler._waiting.values()) == ["a"]
+
+        release.set()
+        await asyncio.wait_for(asyncio.gather(first, *rest), 1.0)
+        assert order == ["a", "b", "a"]
+        assert scheduler.inflight == 0
+
+    asyncio.run(scenario())
+
+
+# ── FairScheduler: 待ち手の取り消し ──────────────────────────────────────────
+def test_cancelled_async_waiter_is_removed_and_next_waiter_proceeds():
+    async def scenario() -> None:
+        scheduler = FairScheduler(limit=1)
+        release = asyncio.Event()
+        order: List[str] = []
+
+        async def worker(name: str) -> None:
+            async with scheduler.aslot(name):
+                order.append(name)
+                await release.wait()
+
+        holder = asyncio.create_task(worker("holder"))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(worker("cancelled"))
+        survivor = asyncio.create_task(worker("survivor"))
+        await asyncio.sleep(0.01)
+        assert len(scheduler._waiting) == 2
+
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert len(scheduler._waiting) == 1
+        assert len(scheduler._async_waiters) == 1
+
+        release.set()
+        await asyncio.wait_for(asyncio.gather(holder, survivor), 1.0)
+        assert order == ["holder", "survivor"]
+        assert scheduler.inflight == 0
+        assert not scheduler._waiting and not scheduler._async_waiters
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_head_waiter_hands_free_slot_to_next():
+    async def scenario() -> None:
+        scheduler = FairScheduler(limit=1)
+        entered = asyncio.Event()
+
+        async def hold() -> None:
+            async with scheduler.aslot("holder"):
+                await asyncio.sleep(10)
+
+        async def wait_then_mark() -> None:
+            async with scheduler.aslot("next"):
+                entered.set()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        head = asyncio.create_task(_enter(scheduler, "head"))
+        follower = asyncio.create_task(wait_then_mark())
+        await asyncio.sleep(0.01)
+
+        # 枠を空けた直後 (head が起こされたが、まだ入っていない時点) に head を取り消す
+        holder.cancel()
+        head.cancel()
+        await asyncio.gather(holder, head, return_exceptions=True)
+        await asyncio.wait_for(entered.wait(), 1.0)
+        await follower
+        assert scheduler.inflight == 0
+
+    asyncio.run(scenario())
+
+
+def test_thread_release_wakes_async_waiter():
+    async def scenario(scheduler: FairScheduler, holder: _Holder) -> None:
+        loop = asyncio.get_running_loop()
+        waiter = asyncio.create_task(_enter(scheduler, "async"))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        await loop.run_in_executor(None, holder.release)
+        await asyncio.wait_for(waiter, 1.0)
+
+    scheduler = FairScheduler(limit=1)
+    holder = _hold(scheduler, "thread", [])
+    asyncio.run(scenario(scheduler, holder))
+    assert scheduler.inflight == 0
+
+
+# ── FairScheduler / AdaptiveLimiter: 上限の変更 ──────────────────────────────
+def test_raising_limit_admits_waiters():
+    scheduler = FairScheduler(limit=1)
+    entered: List[str] = []
+    holders = [_hold(scheduler, "a", entered), _hold(scheduler, "b", entered)]
+    assert entered == ["a"]
+
+    scheduler.set_limit(2)
+    _wait_until(lambda: entered == ["a", "b"])
+    for holder in holders:
+        holder.release()
+    assert scheduler.inflight == 0
+
+
+class _Throttled(Exception):
+    status_code = 429
+
+    class response:
+        headers = {"retry-after-ms": "1"}
+
+
+def _limiter(max_inflight: int = 8) -> AdaptiveLimiter:
+    return AdaptiveLimiter("test", rpm=60_000, tpm=10**9, max_inflight=max_inflight, max_retries=3)
+
+
+def test_throttle_halves_limit_and_successes_recover_it():
+    limiter = _limiter(8)
+    failures = iter([_Throttled(), _Throttled()])
+
+    def fn() -> str:
+        error = next(failures, None)
+        if error is not None:
+            raise error
+        return "ok"
+
+    assert limiter.call(fn) == "ok"
+    # 429 が 2 回 → 8 → 4 → 2
+    assert limiter.concurrency_limit == 2
+    assert limiter._slots.limit == 2
+
+    for _ in range(3):
+        limiter.call(lambda: "ok")
+    assert limiter.concurrency_limit == 3
+
+    for _ in range(100):
+        limiter.call(lambda: "ok")
+    # 回復しても max_inflight は超えない
+    assert limiter.concurrency_limit == 8
+    assert limiter._slots.limit == 8
+
+
+def test_acall_shares_aimd_with_call():
+    limiter = _limiter(4)
+    attempts = []
+
+    async def fn() -> str:
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise _Throttled()
+        return "ok"
+
+    assert asyncio.run(limiter.acall(fn)) == "ok"
+    assert len(attempts) == 2
+    assert limiter.concurrency_limit == 2
+    assert limiter._slots.inflight == 0
+
+
+def test_non_retryable_error_is_raised_without_changing_limit():
+    limiter = _limiter(4)
+
+    def fn() -> str:
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        limiter.call(fn)
+    assert limiter.concurrency_limit == 4
+    assert limiter._slots.inflight == 0
+
+
+def test_span_times_only_the_last_attempt():
+    limiter = _limiter(4)
+    span = Span("test", "m", "draft")
+    attempts = []
+
+    def fn() -> str:
+        attempts.append(time.perf_counter())
+        time.sleep(0.05)
+        if len(attempts) == 1:
+            raise _Throttled()
+        return "ok"
+
+    assert limiter.call(fn, span=span) == "ok"
+    # 失敗した 1 回目と待ち時間は除き、2 回目の送信時刻から計測する
+    assert span.attempt_started is not None and span.attempt_started <= attempts[1]
+    assert span.attempt_started > attempts[0] + 0.05
+    assert span.retry_status == [429]
+
+
+# ── TokenBucket ─────────────────────────────────────────────────────────────
+def test_token_bucket_reports_wait_until_refilled():
+    bucket = TokenBucket(rate_per_min=60)  # 1 個/秒、容量 60
+    assert bucket._take(60) == 0.0
+    assert bucket._take(1) == pytest.approx(1.0, abs=0.05)
+    # 容量を超える要求は容量分で打ち切る (永久に待たない)
+    bucket.drain()
+    assert bucket._take(1000) == pytest.approx(60.0, abs=0.1)